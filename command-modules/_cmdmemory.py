@@ -41,6 +41,27 @@ Command: **"<memory> [<count> times]"**
     the spoken *<name>*.  If *<count>* is also spoken, the series of 
     recognitions is repeated that many times.
 
+Command: **"stop playback"**
+    Stops the playback which is currently running, and any playbacks
+    waiting to run.  This command is only available during playback.
+
+Playback runs in the background, one step at a time, so that other
+commands can be spoken meanwhile; its progress is printed after each
+repetition.
+Recognitions produced by playback are not recorded.
+
+Recognitions of mapping rules are played back by executing the
+actions which those rules produced, without mimicking the words to
+the speech engine again, if their grammar takes part through the
+``rulecapture`` module.  Other recognitions, and actions whose
+context doesn't match the foreground window, are mimicked.  Memories
+loaded from disk are always mimicked.
+
+Memories are stored on disk, so that they are still available after
+Natlink is restarted.  Each memory is appended to the store when it is
+made; the store is compacted when it is loaded, if it contains many
+outdated memories.
+
 """
 
 try:
@@ -49,7 +70,16 @@ try:
 except ImportError:
     pass
 
+import os
+import os.path
+import time
+import mmap
+import struct
+import marshal
+from array import array
 from dragonfly import *
+from dragonfly.timer import timer
+from rulecapture import add_listener, remove_listener
 
 
 #---------------------------------------------------------------------------
@@ -63,26 +93,587 @@ config.lang.start_recording  = Item("start recording <name>")
 config.lang.stop_recording   = Item("stop recording")
 config.lang.playback_memory  = Item("<memory> [<count> times]")
 config.lang.recall           = Item("recall everything")
+config.lang.stop_playback    = Item("stop playback")
+config.history               = Section("History section")
+config.history.capacity      = Item(100, doc="Number of recent recognitions available for playback.")
+config.history.record_capacity = Item(1000, doc="Maximum number of recognitions in one recording.")
+config.playback              = Section("Playback section")
+config.playback.mimic_delay  = Item(1.0, doc="Seconds to wait before mimicking recognitions, so that the engine finishes the current recognition first.")
+config.store                 = Section("Memory store section")
+config.store.path            = Item(os.path.splitext(os.path.abspath(__file__))[0] + "-memories.dat", doc="File in which memories are stored.")
+config.store.compact_ratio   = Item(0.5, doc="Fraction of outdated records above which the store is compacted when loaded.")
 config.load()
 
 
+#---------------------------------------------------------------------------
+# Append-only store of memories.  Each record consists of a header with
+#  the lengths of the name and the data, the UTF-8 encoded name, and the
+#  marshalled series of (words, interval) pairs; a record without data
+#  marks a deleted memory.  The last record of each name is valid.
+#  Loading maps the file into memory and only reads the names; series
+#  are decoded when their memory is first played back.
+
+class MemoryStore(object):
+
+    header = struct.Struct("<II")
+
+    def __init__(self, path):
+        self.path = path
+        self._map = None
+
+    def load(self):
+        # Return a dict of name -> LazyPlayback of all stored memories.
+        self.close()
+        self._recover()
+        if not os.path.isfile(self.path) or not os.path.getsize(self.path):
+            return {}
+        offsets, records, valid_size = self._scan()
+        if valid_size < os.path.getsize(self.path):
+            # Drop an incomplete record left by an interrupted save.
+            self._truncate(valid_size)
+            offsets, records, valid_size = self._scan()
+        if records and 1 - float(len(offsets)) / records \
+                > config.store.compact_ratio:
+            self.compact(offsets)
+            offsets, records, valid_size = self._scan()
+        return dict([(name, LazyPlayback(self, offset, length))
+                     for name, (offset, length) in offsets.iteritems()])
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def save(self, name, series):
+        self._append(self._encode(name, series))
+
+    def delete(self, name):
+        self._append(self._encode(name, None))
+
+    def read(self, offset, length):
+        return marshal.loads(self._map[offset:offset + length])
+
+    def compact(self, offsets):
+        # Rewrite the valid records to a new file, which then replaces
+        #  the old one.  The old file is only removed once the new one
+        #  is complete, so an interrupted compaction leaves either the
+        #  old file or the complete new one, which _recover() restores.
+        temp_path = self.path + ".tmp"
+        f = open(temp_path, "wb")
+        try:
+            for name, (offset, length) in offsets.iteritems():
+                f.write(self._encode(name, self.read(offset, length)))
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        self.close()
+        os.remove(self.path)
+        os.rename(temp_path, self.path)
+
+    def _recover(self):
+        # Finish or discard a compaction which was interrupted.
+        temp_path = self.path + ".tmp"
+        if not os.path.isfile(temp_path):
+            return
+        if os.path.isfile(self.path):
+            os.remove(temp_path)    # Interrupted while writing.
+        else:
+            os.rename(temp_path, self.path)
+
+    def _scan(self):
+        f = open(self.path, "rb")
+        try:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        offsets = {}                # Name -> (data offset, data length).
+        records = 0
+        position = 0
+        size = len(self._map)
+        while position + self.header.size <= size:
+            name_length, data_length = self.header.unpack_from(self._map,
+                                                               position)
+            start = position + self.header.size
+            end = start + name_length + data_length
+            if end > size:
+                break               # Incomplete last record.
+            name = self._map[start:start + name_length].decode("utf-8")
+            if data_length:
+                offsets[name] = (start + name_length, data_length)
+            else:
+                offsets.pop(name, None)
+            records += 1
+            position = end
+        return offsets, records, position
+
+    def _truncate(self, size):
+        self.close()
+        f = open(self.path, "r+b")
+        try:
+            f.truncate(size)
+        finally:
+            f.close()
+
+    def _encode(self, name, series):
+        name = unicode(name).encode("utf-8")
+        if series is None:
+            data = ""
+        else:
+            data = marshal.dumps([(tuple(words), float(interval))
+                                  for words, interval in series])
+        return self.header.pack(len(name), len(data)) + name + data
+
+    def _append(self, record):
+        f = open(self.path, "ab")
+        try:
+            f.write(record)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+
+
+class LazyPlayback(ActionBase):
+
+    uses_mimic = True
+
+    def __init__(self, store, offset, length):
+        ActionBase.__init__(self)
+        self._store = store
+        self._location = (offset, length)
+        self._playback = None
+
+    speed = property(lambda self: self._get_playback().speed)
+
+    def get_steps(self):
+        return self._get_playback().get_steps()
+
+    def _get_playback(self):
+        if self._playback is None:
+            series = self._store.read(*self._location)
+            self._playback = new_playback(series)
+        return self._playback
+
+    def _execute(self, data=None):
+        return self._get_playback().execute(data)
+
+
+def new_playback(series):
+    # Playback at 10x original speed.
+    return MacroPlayback([(words, interval, None)
+                          for words, interval in series])
+
+
+#---------------------------------------------------------------------------
+# Recognition history which keeps a bounded number of recent
+#  recognitions.  Entries are compact records of word ids, which index
+#  a table shared by all histories, and the time of the recognition.
+#  Like PlaybackHistory, items are (words, interval) pairs, where the
+#  interval is the time until the next recognition, and slices are
+#  Playback actions.
+
+class WordTable(object):
+
+    def __init__(self):
+        self.ids = {}               # Word -> id.
+        self.words = []             # Id -> word.
+
+    def encode(self, words):
+        ids = array("l")
+        for word in words:
+            word_id = self.ids.get(word)
+            if word_id is None:
+                word_id = self.ids[word] = len(self.words)
+                self.words.append(word)
+            ids.append(word_id)
+        return ids
+
+    def decode(self, ids):
+        return tuple([self.words[i] for i in ids])
+
+
+word_table = WordTable()
+
+
+class HistoryRecord(object):
+
+    __slots__ = ("word_ids", "time", "step")
+
+    def __init__(self, word_ids, time, step=None):
+        self.word_ids = word_ids
+        self.time = time
+        self.step = step
+
+
+class CompactPlaybackHistory(RecognitionObserver):
+
+    def __init__(self, capacity):
+        RecognitionObserver.__init__(self)
+        self.capacity = capacity
+        self._records = [None] * capacity
+        self._start = 0             # Index of the oldest record.
+        self._count = 0
+        self._complete = True
+        self._expected = []         # Words which playback will mimic.
+        self._appended = False      # Whether this utterance was appended.
+        self._captured = None       # (words, step) of this utterance.
+        self._registered = False
+
+    complete = property(lambda self: self._complete)
+    registered = property(lambda self: self._registered)
+
+    def register(self):
+        RecognitionObserver.register(self)
+        self._registered = True
+
+    def unregister(self):
+        RecognitionObserver.unregister(self)
+        self._registered = False
+
+    def expect(self, words):
+        self._expected.append(tuple(words))
+
+    def clear_expected(self):
+        self._expected = []
+
+    #-----------------------------------------------------------------------
+    # Recognition observer callbacks.
+
+    def on_begin(self):
+        self._complete = False
+        self._appended = False
+        self._captured = None
+
+    def on_recognition(self, words):
+        self._complete = True
+        words = tuple(words)
+        step = None
+        if self._captured is not None and self._captured[0] == words:
+            step = self._captured[1]
+        self._captured = None
+        if words in self._expected:
+            self._expected.remove(words)    # Produced by playback.
+            return
+        self.append(words, step=step)
+        self._appended = True
+
+    def on_failure(self):
+        self._complete = True
+
+    #-----------------------------------------------------------------------
+    # Sequence methods.
+
+    def append(self, words, when=None, step=None):
+        if when is None:
+            when = time.time()
+        record = HistoryRecord(word_table.encode(words), when, step)
+        index = (self._start + self._count) % self.capacity
+        self._records[index] = record
+        if self._count < self.capacity:
+            self._count += 1
+        else:
+            self._start = (self._start + 1) % self.capacity
+
+    def pop(self):
+        if not self._count:
+            raise IndexError("pop from empty history")
+        item = self[-1]
+        index = (self._start + self._count - 1) % self.capacity
+        self._records[index] = None
+        self._count -= 1
+        return item
+
+    def capture(self, words, step):
+        # Called when the rule of the current utterance is processed,
+        #  which may be before or after this observer is notified of
+        #  the recognition.
+        if not self._appended:
+            self._captured = (words, step)
+            return
+        if not self._count:
+            return
+        record = self._get_record(self._count - 1)
+        if record.step is None \
+                and word_table.decode(record.word_ids) == words:
+            record.step = step
+
+    def get_steps(self, count=None):
+        # Return (words, interval, step) of the last *count* records.
+        start = 0
+        if count is not None:
+            start = max(self._count - count, 0)
+        steps = []
+        for index in xrange(start, self._count):
+            words, interval = self._get_item(index)
+            steps.append((words, interval, self._get_record(index).step))
+        return steps
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        for index in xrange(self._count):
+            yield self._get_item(index)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            indices = xrange(*index.indices(self._count))
+            series = [self._get_item(i) for i in indices]
+            return Playback(series)
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError("history index out of range")
+        return self._get_item(index)
+
+    def __delitem__(self, index):
+        # Only deleting everything, "del history[:]", is supported.
+        if index != slice(None, None, None):
+            raise TypeError("only del history[:] is supported")
+        self._records = [None] * self.capacity
+        self._start = 0
+        self._count = 0
+        self._appended = False
+        self._captured = None
+
+    def _get_record(self, index):
+        return self._records[(self._start + index) % self.capacity]
+
+    def _get_item(self, index):
+        record = self._get_record(index)
+        if index + 1 < self._count:
+            interval = self._get_record(index + 1).time - record.time
+        else:
+            interval = 0.0
+        return (word_table.decode(record.word_ids), interval)
+
+
+#---------------------------------------------------------------------------
+# Capture of the actions produced by mapping rules.  Grammars which
+#  take part through the rulecapture module report the action of each
+#  recognition of their mapping rules, and the extras to bind it with;
+#  these are handed to the histories.  Recognitions of other rules are
+#  mimicked during playback.
+
+class CompiledStep(object):
+
+    __slots__ = ("action", "extras", "contexts")
+
+    def __init__(self, action, extras, contexts):
+        self.action = action
+        self.extras = extras
+        self.contexts = contexts
+
+    def matches(self, window):
+        for context in self.contexts:
+            if not context.matches(window.executable, window.title,
+                                   window.handle):
+                return False
+        return True
+
+    def execute(self):
+        self.action.execute(self.extras)
+
+
+class RuleCapture(object):
+
+    def __init__(self):
+        self.histories = []
+
+    def install(self):
+        add_listener(self.captured)
+
+    def uninstall(self):
+        remove_listener(self.captured)
+
+    def captured(self, rule, words, action, extras):
+        contexts = [c for c in (getattr(rule, "context", None),
+                                getattr(rule.grammar, "context", None))
+                    if c is not None]
+        step = CompiledStep(action, extras, contexts)
+        for history in self.get_registered():
+            history.capture(words, step)
+
+    def get_registered(self):
+        # Only histories which currently observe recognitions are
+        #  given captured steps and the words which playback mimics.
+        return [h for h in self.histories if h.registered]
+
+
+rule_capture = RuleCapture()
+
+
+#---------------------------------------------------------------------------
+# Playback action which executes compiled steps directly, and mimics
+#  the other steps.  Executing it plays all steps at once; the
+#  scheduler below plays its steps one at a time instead.
+
+def play_step(words, step):
+    # Execute a single step; return whether its words were mimicked.
+    if step is not None and step.matches(Window.get_foreground()):
+        step.execute()
+        return False
+    for history in rule_capture.get_registered():
+        history.expect(words)
+    Mimic(*words).execute()
+    return True
+
+
+class MacroPlayback(ActionBase):
+
+    def __init__(self, steps, speed=10):
+        ActionBase.__init__(self)
+        self._steps = steps
+        self.speed = speed
+
+    @property
+    def uses_mimic(self):
+        for words, interval, step in self._steps:
+            if step is None:
+                return True
+        return False
+
+    def get_steps(self):
+        return self._steps
+
+    def _execute(self, data=None):
+        for words, interval, step in self._steps:
+            if play_step(words, step):
+                time.sleep(interval / self.speed)
+
+
+#---------------------------------------------------------------------------
+# Scheduler which plays back in the background, one playback at a
+#  time.  Natlink is not thread-safe, so steps are not executed by a
+#  separate thread: dragonfly's timer, which shares Natlink's single
+#  timer callback between all command-modules, calls the scheduler on
+#  the recognition thread.  It executes the steps which are due and
+#  then returns, so that other commands, such as "stop playback", can
+#  be recognized between steps.
+
+class PlaybackScheduler(object):
+
+    tick_interval = 0.02        # Seconds between timer callbacks.
+    tick_budget = 0.05          # Seconds of steps executed per callback.
+
+    def __init__(self):
+        self._playbacks = []        # (name, playback, count) tuples.
+        self._steps = None
+        self._index = 0             # Index of the next step.
+        self._repetition = 0        # Number of finished repetitions.
+        self._due = 0.0             # Time at which the next step is due.
+        self._timer_active = False
+
+    @property
+    def idle(self):
+        return not self._playbacks
+
+    def submit(self, name, action, count):
+        self._playbacks.append((name, action, count))
+        if len(self._playbacks) == 1:
+            self._begin()
+        self._set_timer(True)
+
+    def cancel(self):
+        if self._playbacks:
+            name, action, count = self._playbacks[0]
+            print "Playback of %s cancelled after %d of %d." \
+                  % (name, self._repetition, count)
+            for name, action, count in self._playbacks[1:]:
+                print "Playback of %s cancelled." % name
+        self._playbacks = []
+        self._finish()
+
+    def _begin(self):
+        name, action, count = self._playbacks[0]
+        self._steps = action.get_steps()
+        self._index = 0
+        self._repetition = 0
+        self._due = time.time()
+        if getattr(action, "uses_mimic", True):
+            # Let the engine finish the current recognition first.
+            self._due += config.playback.mimic_delay
+
+    def _finish(self):
+        for history in rule_capture.histories:
+            history.clear_expected()
+        self._set_timer(False)
+        set_stop_active(False)
+
+    def _set_timer(self, active):
+        if active == self._timer_active:
+            return
+        if active: timer.add_callback(self._tick, self.tick_interval)
+        else:      timer.remove_callback(self._tick)
+        self._timer_active = active
+
+    def _tick(self):
+        start = time.time()
+        while self._playbacks and time.time() >= self._due \
+                and time.time() - start < self.tick_budget:
+            try:
+                self._play_next()
+            except Exception, e:
+                name = self._playbacks[0][0]
+                print "Playback of %s failed: %s" % (name, e)
+                self._next_playback()
+        if not self._playbacks:
+            self._finish()
+
+    def _play_next(self):
+        name, action, count = self._playbacks[0]
+        if self._index < len(self._steps):
+            words, interval, step = self._steps[self._index]
+            self._index += 1
+            if play_step(words, step):
+                self._due = time.time() + interval / action.speed
+            return
+
+        self._repetition += 1
+        print "Playback of %s: %d of %d done." % (name, self._repetition,
+                                                  count)
+        if self._repetition < count:
+            self._index = 0
+        else:
+            self._next_playback()
+
+    def _next_playback(self):
+        self._playbacks.pop(0)
+        for history in rule_capture.histories:
+            history.clear_expected()
+        if self._playbacks:
+            self._begin()
+
+
+scheduler = PlaybackScheduler()
+
+
 #---------------------------------------------------------------------------
 # Create global dicts for storing command memories.
 
-# Dictionary for storing memories.
+# Dictionary for storing memories; stored memories are added at once.
 memories     = DictList("memories")
 memories_ref = DictListRef("memory", memories)
+memory_store = MemoryStore(config.store.path)
+try:
+    memories.set(memory_store.load())
+except (IOError, OSError, ValueError, EOFError), e:
+    print "Warning, failed to load stored memories: %s" % e
 
 # Recognition observer for retrieving recently heard recognitions.
-playback_history = PlaybackHistory()
+playback_history = CompactPlaybackHistory(config.history.capacity)
 try:
     playback_history.register()
 except Exception, e:
     print "Warning, failed to register playback_history: %s" % e
 
-record_history = PlaybackHistory()
+record_history = CompactPlaybackHistory(config.history.record_capacity)
 record_name = None
 
+rule_capture.histories.extend([playback_history, record_history])
+rule_capture.install()
+
 
 #---------------------------------------------------------------------------
 # Define this module's main functionality and rule.
@@ -97,25 +688,30 @@ def playback_last(n, count):
     # Retrieve playback-action from recognition observer.
     if playback_history and playback_history.complete: 
         playback_history.pop()      # Remove playback recognition itself.
-    action = playback_history[-n:]  # Retrieve last *n* recognitions.
-    action.speed = 10               # Playback at 10x original speed.
+    action = MacroPlayback(playback_history.get_steps(n))
+    start_playback("last %d commands" % n, action, count)
 
-    # Playback action.
-    import time; time.sleep(1)
-    playback_history.unregister()   # Don't record playback.
-    try:
-        for index in range(count):  # Playback *count* times.
-            action.execute()        # Perform playback.
-    finally:
-        playback_history.register() # Continue recording after playback.
+def start_playback(name, action, count):
+    # Only listen exclusively for "stop playback" if the playback
+    #  doesn't need other grammars to recognize mimicked words.
+    exclusive = scheduler.idle and not getattr(action, "uses_mimic", True)
+    set_stop_active(True, exclusive)
+    scheduler.submit(name, action, count)
 
 def remember(n, name):
     # Retrieve playback-action from recognition observer and store it.
     if playback_history and playback_history.complete: 
         playback_history.pop()      # Remove playback recognition itself.
-    action = playback_history[-n:]  # Retrieve last *n* recognitions.
-    action.speed = 10               # Playback at 10x original speed.
-    memories[str(name)] = action    # Store playback action.
+    steps = playback_history.get_steps(n)   # Last *n* recognitions.
+    store_memory(str(name), steps)
+
+def store_memory(name, steps):
+    memories[name] = MacroPlayback(steps)   # Store playback action.
+    series = [(words, interval) for words, interval, step in steps]
+    try:
+        memory_store.save(name, series)
+    except (IOError, OSError), e:
+        print "Warning, failed to store memory %r: %s" % (name, e)
 
 def start_recording(name):
     global record_name
@@ -130,22 +726,14 @@ def stop_recording():
         record_history.pop()        # Remove playback recognition itself.
     if not record_name:
         return
-    action = record_history[:]
-    action.speed = 10               # Playback at 10x original speed.
-    memories[record_name] = action  # Store playback action.
+    store_memory(record_name, record_history.get_steps())
     record_name = None   
 
 def playback_memory(count, memory):
     if playback_history and playback_history.complete:
         playback_history.pop()      # Remove playback recognition itself.
-
-    # Playback remembered action.
-    playback_history.unregister()   # Don't record playback.
-    try:
-        for index in range(count):  # Playback *count* times.
-            memory.execute()        # Perform playback.
-    finally:
-        playback_history.register() # Continue recording after playback.
+    names = [n for n, m in memories.items() if m is memory] or ["memory"]
+    start_playback(repr(names[0]), memory, count)
 
 
 class PlaybackRule(MappingRule):
@@ -177,17 +765,50 @@ class PlaybackRule(MappingRule):
                }
 
 
+class StopPlaybackRule(CompoundRule):
+
+    spec = config.lang.stop_playback
+
+    def _process_recognition(self, node, extras):
+        scheduler.cancel()
+
+
+#---------------------------------------------------------------------------
+# Grammar for stopping playback.  It is loaded with its rule disabled;
+#  the rule is enabled when playback starts, and disabled again by the
+#  scheduler when playback has finished or was cancelled.
+
+def set_stop_active(active, exclusive=False):
+    if active:
+        stop_rule.enable()
+        stop_grammar.set_exclusive(exclusive)
+    elif stop_rule.enabled:
+        stop_grammar.set_exclusive(False)
+        stop_rule.disable()
+
+
 #---------------------------------------------------------------------------
-# Create and load this module's grammar.
+# Create and load this module's grammars.
 
 grammar = Grammar("command memory")     # Create this module's grammar.
 grammar.add_rule(PlaybackRule())        # Add the top-level rule.
 grammar.load()                          # Load the grammar.
 
+stop_grammar = Grammar("command memory playback")
+stop_rule = StopPlaybackRule()
+stop_grammar.add_rule(stop_rule)
+stop_grammar.load()
+stop_rule.disable()
+
 # Unload function which will be called at unload time.
 def unload():
     playback_history.unregister()
     record_history.unregister()
-    global grammar
+    rule_capture.uninstall()
+    scheduler.cancel()
+    global grammar, stop_grammar
     if grammar: grammar.unload()
     grammar = None
+    if stop_grammar: stop_grammar.unload()
+    stop_grammar = None
+    memory_store.close()
@@ -10,6 +10,11 @@ Command-module to control **Windows Explorer**
 
 This module defines various voice-commands for use with Windows Explorer.
 
+File commands, such as "scan for viruses" or "extract archive here",
+run their external programs in the background.  The commands "list
+jobs", "cancel job <n>" and "show job log <n>" of the ``jobtools``
+module are available to follow and control them.
+
 .. note::
 
    This module is still under development.
@@ -30,56 +35,105 @@ except ImportError:
     pass
 
 import os.path
-import string
-import subprocess
 import time
-from urllib import unquote
-from dragonfly import (ConnectionGrammar, AppContext, CompoundRule,
+from dragonfly import (Grammar, ConnectionGrammar, AppContext, CompoundRule,
                        Choice, Window, Config, Section, Item)
+from comtools  import profile_rules, profile_application
+from shelltools import shell_windows
+from jobtools  import (JobRunner, ListJobsRule, CancelJobRule,
+                       ShowJobLogRule, split_arguments, write_response_file,
+                       launch)
+from jobtools  import config as job_config
+from archivetools import free_archive_path, get_archiver
+
+
+#---------------------------------------------------------------------------
+# Set up this module's configuration.
+
+config              = Config("Explorer control")
+config.jobs         = Section("Job section")
+config.jobs.workers = Item(2, doc="Number of file commands which can run at the same time.")
+#config.generate_config_file()
+config.load()
+
+
+#---------------------------------------------------------------------------
+# Runner for the external programs started by file commands.  Programs
+#  run in the background; their output is logged per job.
+
+runner = JobRunner("Explorer", config.jobs.workers)
+
+def job_name(arguments, paths):
+    program = os.path.basename(arguments[0])
+    return "%s (%d files)" % (program, len(paths))
 
 
 #---------------------------------------------------------------------------
 
 class SingleFile(object):
 
-    def __init__(self, spec, command_line):
+    # Interactive programs, such as editors, are launched directly
+    #  instead of being run as a job, because they would otherwise
+    #  hold one of the runner's workers until they are closed.
+
+    def __init__(self, spec, command_line, interactive=False):
         self.spec = spec
         self.command_line = command_line
+        self.interactive = interactive
 
     def execute(self, paths, directory):
-        for path in paths:
-            self.execute_single(path, directory)
+        commands = [self.get_arguments(path, directory) for path in paths]
+        if self.interactive:
+            for arguments in commands:
+                launch(arguments)
+            return
+        runner.submit(job_name(self.command_line, paths), commands)
 
-    def execute_single(self, path, directory):
+    def get_arguments(self, path, directory):
         data = {"path": path, "dir": directory}
-        arguments = [s % data for s in self.command_line]
-        print "Arguments: %r" % arguments
-        process = subprocess.Popen(arguments, stdout=subprocess.PIPE)
-        out, err = process.communicate()
-        print "Output:"; print out and out.strip()
-        print "Error:"; print err and err.strip()
+        return [s % data for s in self.command_line]
 
 
 class MultiFile(object):
 
-    def __init__(self, spec, command_line_pre, command_line_post):
+    # Large selections are split into chunks which are submitted as
+    #  separate jobs, so that they run concurrently and each have
+    #  their own output log.  If *response_file* is given, e.g. "@%s",
+    #  the paths of each chunk are written to a file which is passed
+    #  to the program instead of the paths themselves.
+
+    def __init__(self, spec, command_line_pre, command_line_post,
+                 response_file=None):
         self.spec = spec
         self.command_line_pre  = command_line_pre
         self.command_line_post = command_line_post
+        self.response_file = response_file
 
     def execute(self, paths, directory):
         data = {"dir": directory}
         arguments_pre  = [s % data for s in self.command_line_pre]
         arguments_post = [s % data for s in self.command_line_post]
-        arguments = arguments_pre + paths
-        if arguments_post:
-            arguments += arguments_post
 
-        print "Arguments: %r" % arguments
-        process = subprocess.Popen(arguments, stdout=subprocess.PIPE)
-        out, err = process.communicate()
-        print "Output:"; print out and out.strip()
-        print "Error:"; print err and err.strip()
+        if self.response_file:
+            size = job_config.jobs.response_file_size
+            chunks = [paths[i:i+size] for i in xrange(0, len(paths), size)]
+        else:
+            chunks = split_arguments(arguments_pre, paths, arguments_post,
+                                     job_config.jobs.command_line_limit)
+
+        for index, chunk in enumerate(chunks):
+            temp_files = []
+            if self.response_file:
+                list_path = write_response_file(chunk)
+                temp_files.append(list_path)
+                arguments = [self.response_file % list_path]
+            else:
+                arguments = chunk
+            arguments = arguments_pre + arguments + arguments_post
+            name = job_name(arguments, chunk)
+            if len(chunks) > 1:
+                name += " chunk %d/%d" % (index + 1, len(chunks))
+            runner.submit(name, [arguments], temp_files)
 
 
 class CreateArchiveHere(object):
@@ -89,35 +143,28 @@ class CreateArchiveHere(object):
         self.extension = extension
 
     def execute(self, paths, directory):
-        archive_path = os.path.splitext(os.path.basename(paths[0]))[0]
-        archive_path = os.path.join(directory, archive_path)
-        archive_path += time.strftime("-%y%m%d")
-
-        def filenames(basename, extension):
-#            yield basename + extension
-            for letter in string.lowercase:
-                yield basename + letter + extension
-
-        available = False
-        for archive_path in filenames(archive_path, self.extension):
-            if not os.path.exists(archive_path):
-                available = True
-                break
-        if not available:
+        basename = os.path.splitext(os.path.basename(paths[0]))[0]
+        basename += time.strftime("-%y%m%d")
+        archive_path = free_archive_path(directory, basename, self.extension)
+        if not archive_path:
             print "Warning: could not create archive."
             return
 
+        # Zip and tar archives are created in-process; other formats
+        #  are left to 7-Zip.
+        archiver = get_archiver(archive_path, paths, self.extension)
+        if archiver:
+            name = "%s (%d files)" % (os.path.basename(archive_path),
+                                      len(paths))
+            runner.submit(name, [archiver])
+            return
+
         arguments = [r"C:\Program Files\7-Zip\7z.exe", "a"]
         arguments.append("-o" + directory)
         arguments.append(archive_path)
 #        arguments.append(os.path.splitext(archive_path)[0])
         arguments.extend(paths)
-
-        print "Arguments: %r" % arguments
-        process = subprocess.Popen(arguments, stdout=subprocess.PIPE)
-        out, err = process.communicate()
-        print "Output:"; print out and out.strip()
-        print "Error:"; print err and err.strip()
+        runner.submit(job_name(arguments, paths), [arguments])
 
 class RenameFile(object):
 
@@ -135,32 +182,26 @@ class RenameFile(object):
         path = paths[0]
 
         arguments = [self.python_path, self.rename_dialog_path, path]
-        subprocess.Popen(arguments)
+        launch(arguments)
 
 
 #---------------------------------------------------------------------------
 
 commands = [
             SingleFile("open with ultra [edit]",
-                       [r"C:\Program Files\IDM Computer Solutions\UltraEdit\Uedit32.exe", "%(path)s"]),
+                       [r"C:\Program Files\IDM Computer Solutions\UltraEdit\Uedit32.exe", "%(path)s"],
+                       interactive=True),
             MultiFile("scan for (virus | viruses) | virus scan",
                        [r"C:\Program Files\F-Secure\Anti-Virus\fsav.exe"], ["/list"]),
             SingleFile("extract archive here",
                        [r"C:\Program Files\7-Zip\7z.exe", "x", "-o%(dir)s", "%(path)s"]),
             CreateArchiveHere("create zip archive here", ".zip"),
+            CreateArchiveHere("create tar archive here", ".tar.gz"),
             CreateArchiveHere("create [7] archive here", ".7z"),
             RenameFile("rename file dialog"),
            ]
 
 
-#---------------------------------------------------------------------------
-# Utility generator function for iterating over COM collections.
-
-def collection_iter(collection):
-    for index in xrange(collection.Count):
-        yield collection.Item(index)
-
-
 #---------------------------------------------------------------------------
 # This module's main grammar.
 
@@ -174,33 +215,41 @@ class ControlGrammar(ConnectionGrammar):
             app_name="Shell.Application"
            )
 
-    def get_active_explorer(self):
+    def connection_up(self):
+        profile_application(self)
+
+    def connection_down(self):
+        shell_windows.reset()
+
+    def _process_begin(self, executable, title, handle):
+        shell_windows.begin()
+        ConnectionGrammar._process_begin(self, executable, title, handle)
+
+    def get_selection(self):
         handle = Window.get_foreground().handle
-        for window in collection_iter(self.application.Windows()):
-            if window.HWND == handle:
-                return window
-        self._log.warning("%s: no active explorer." % self)
-        return None
+        selection = shell_windows.get_selection(self.application, handle)
+        if selection is None:
+            self._log.warning("%s: no active explorer." % self)
+        return selection
 
     def get_selected_paths(self):
-        window = self.get_active_explorer()
-        items = window.Document.SelectedItems()
-        paths = []
-        for item in collection_iter(items):
-            paths.append(item.Path)
-        print "Selected paths: %r" % paths
-        return paths
+        selection = self.get_selection()
+        if selection is None:
+            return []
+        print "Selected paths: %r" % (selection.paths,)
+        return list(selection.paths)
 
     def get_selected_filenames(self):
-        paths = self.get_selected_paths()
-        return [os.path.basename(p) for p in paths]
+        selection = self.get_selection()
+        if selection is None:
+            return []
+        return selection.filenames
 
     def get_current_directory(self):
-        window = self.get_active_explorer()
-        path = window.LocationURL[8:]
-        if path.startswith("file:///"):
-            path = path[8:]
-        return unquote(path)
+        selection = self.get_selection()
+        if selection is None:
+            return None
+        return selection.directory
 
 grammar = ControlGrammar()
 
@@ -226,10 +275,11 @@ class CommandRule(CompoundRule):
 
     def _process_recognition(self, node, extras):
         command = extras["command"]
-        paths = self.grammar.get_selected_paths()
-        directory = self.grammar.get_current_directory()
-        print "Selected paths: %r" % paths
-        command.execute(paths, directory)
+        selection = self.grammar.get_selection()
+        if selection is None:
+            return
+        print "Selected paths: %r" % (selection.paths,)
+        command.execute(list(selection.paths), selection.directory)
 
 grammar.add_rule(CommandRule())
 
@@ -237,10 +287,21 @@ grammar.add_rule(CommandRule())
 #---------------------------------------------------------------------------
 # Load the grammar instance and define how to unload it.
 
+profile_rules(grammar)
 grammar.load()
 
+# Job control commands are available globally, so that jobs can be
+#  inspected and cancelled while working in other applications.
+job_grammar = Grammar("Explorer jobs")
+job_grammar.add_rule(ListJobsRule())
+job_grammar.add_rule(CancelJobRule())
+job_grammar.add_rule(ShowJobLogRule())
+job_grammar.load()
+
 # Unload function which will be called by natlink at unload time.
 def unload():
-    global grammar
+    global grammar, job_grammar
     if grammar: grammar.unload()
     grammar = None
+    if job_grammar: job_grammar.unload()
+    job_grammar = None
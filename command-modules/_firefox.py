@@ -19,6 +19,22 @@ search bar and Firefox's keyword searching.  It also
 allows single-utterance submitting of text into form text 
 fields.
 
+Link commands wait between their keystrokes, e.g. for a context menu
+to open.  Instead of always waiting the configured number of
+hundredths of a second, these commands measure how long each
+keystroke takes to show its effect, such as the context menu
+appearing, and learn how long each step really needs, with a safety
+margin.  Until enough measurements are available, and for steps
+without a visible effect, the configured delays are used.
+
+Commands for links, searching and text size are grouped into features,
+which are deactivated when they haven't been used for a while.  If an
+utterance in Firefox isn't recognized while features are deactivated
+this way, they are activated again, so that the command can simply be
+repeated.  Say "enable <feature> commands", e.g. "enable link
+commands", to activate one explicitly.  Features which are used often
+stay active.
+
 Installation
 ----------------------------------------------------------------------------
 
@@ -44,7 +60,16 @@ try:
 except ImportError:
     pass
 
+import re
+import time
+import threading
+import win32api
+import win32gui
+import win32con
+import win32process
 from dragonfly import *
+from textemit import FastText
+from rulecapture import capture_rules
 
 
 #---------------------------------------------------------------------------
@@ -71,6 +96,19 @@ config.search.searchbar = Item(
                               doc="Spoken-forms of search engines in the Firefox search-bar; they must be given in the same order here as they are available in Firefox.",
                              )
 
+config.calibration             = Section("Keystroke delay calibration section")
+config.calibration.enabled     = Item(True, doc="Whether to learn the delays of link commands instead of using the configured ones.")
+config.calibration.margin      = Item(1.5, doc="Factor by which the slowest measured response is multiplied.")
+config.calibration.min_delay   = Item(0.01, doc="Minimum delay in seconds, even if the application responds immediately.")
+config.calibration.samples     = Item(20, doc="Number of recent measurements remembered per application and step.")
+config.calibration.min_samples = Item(5, doc="Number of measurements needed before learned delays are used.")
+
+config.features                = Section("Feature rules section")
+config.features.active         = Item(["links", "search", "text size"], doc="Features whose commands are active at startup.")
+config.features.idle_minutes   = Item(30, doc="Number of minutes after which an unused feature is deactivated.")
+config.features.sticky_uses    = Item(5, doc="Number of uses after which a feature stays active.")
+config.features.wake_on_failure = Item(True, doc="Whether idle features are activated again when an utterance isn't recognized.")
+
 config.lang                        = Section("Language section")
 config.lang.new_win                = Item("new (window | win)")
 config.lang.new_tab                = Item("new (tab | sub)")
@@ -122,6 +160,8 @@ config.lang.link_dictation_box      = Item("edit [link] <link>")
 config.lang.link_assign_keyword    = Item("assign [a] keyword to [link] <link>")
 config.lang.tabify_links           = Item("tab if I <links>")
 config.lang.tabify_links_sep       = Item("comma")
+config.lang.enable_feature         = Item("enable <name> commands")
+config.lang.disable_feature        = Item("disable <name> commands")
 
 config.lang.search_text            = Item("[power] search [for] <text>")
 config.lang.search_keyword_text    = Item("[power] search <keyword> [for] <text>")
@@ -149,17 +189,288 @@ class LinkRule(Rule):
     def __init__(self):
         element = Number(zero=True)
         Rule.__init__(self, "link_rule", element, exported=False)
+        self._link_keys = {}        # Link number -> keystrokes.
 
     def value(self, node):
         # Format and return keystrokes to select the link.
-        digits = str(node.children[0].value())
-        link_keys = "f6,s-f6," + ",".join(["numpad"+i for i in digits])
+        number = node.children[0].value()
+        link_keys = self._link_keys.get(number)
+        if link_keys is None:
+            digits = str(number)
+            link_keys = "f6,s-f6," + ",".join(["numpad"+i for i in digits])
+            self._link_keys[number] = link_keys
         self._log.debug("Link keys: %r" % link_keys)
         return link_keys
 
 link = RuleRef(name="link", rule=LinkRule())
 
 
+#---------------------------------------------------------------------------
+# Keystroke delays learned from measured response times.  After each
+#  step of a CalibratedKey action, the windows of the application are
+#  watched until the step visibly takes effect: a menu or dialog opens
+#  or closes, or the foreground window or its title changes.  The time
+#  this takes is how long the step really needs; the slowest recent
+#  response of each application and step, times a safety margin, is
+#  used as the delay.  Steps without a visible effect are not measured
+#  and always wait their configured delay.
+
+def get_window_state(handle):
+    # Return the foreground window, its title and the visible windows
+    #  of the thread which owns *handle*.
+    thread_id = win32process.GetWindowThreadProcessId(handle)[0]
+    windows = []
+    def callback(window, windows):
+        if win32gui.IsWindowVisible(window):
+            windows.append(window)
+        return True
+    try:
+        win32gui.EnumThreadWindows(thread_id, callback, windows)
+    except win32gui.error:
+        pass
+    windows.sort()
+    foreground = win32gui.GetForegroundWindow()
+    return foreground, win32gui.GetWindowText(foreground), tuple(windows)
+
+
+class DelayCalibrator(object):
+
+    poll_interval = 0.005
+
+    def __init__(self):
+        self.samples = {}           # (executable, step) -> [seconds].
+
+    def get_delay(self, executable, step, default):
+        samples = self.samples.get((executable, step))
+        if not samples or len(samples) < config.calibration.min_samples:
+            return default
+        return max(max(samples) * config.calibration.margin,
+                   config.calibration.min_delay)
+
+    def record(self, executable, step, seconds):
+        samples = self.samples.setdefault((executable, step), [])
+        samples.append(seconds)
+        del samples[:-config.calibration.samples]
+
+    def wait_for_change(self, handle, before, timeout):
+        # Return the time until the window state differs from *before*,
+        #  or None if it didn't change within *timeout* seconds.
+        start = time.clock()
+        while True:
+            elapsed = time.clock() - start
+            try:
+                if get_window_state(handle) != before:
+                    return elapsed
+            except win32gui.error:
+                return None
+            if elapsed >= timeout:
+                return None
+            time.sleep(self.poll_interval)
+
+
+calibrator = DelayCalibrator()
+
+
+class CalibratedKey(DynStrActionBase):
+
+    # Same spec as Key, e.g. "%(link)s, shift/10, apps/20, t".  Steps
+    #  which end with a delay ("shift/10") wait the learned delay of
+    #  that step; other steps are sent as they are.
+
+    step_pattern = re.compile(r"^(.*?)/(\d+(?:\.\d+)?)$")
+
+    def _parse_spec(self, spec):
+        steps = []
+        for part in spec.split(","):
+            part = part.strip()
+            if not part:
+                continue
+            match = self.step_pattern.match(part)
+            if match and ":" not in match.group(1):
+                key_spec = match.group(1).strip()
+                delay = float(match.group(2)) / 100
+            else:
+                key_spec, delay = part, None
+            if steps and steps[-1][1] is None:
+                # Join consecutive steps without delays.
+                key_spec = steps.pop()[0] + ", " + key_spec
+            steps.append((key_spec, delay))
+        return steps
+
+    def _execute_events(self, steps):
+        window = Window.get_foreground()
+        executable = window.executable
+        previous = None
+        for key_spec, default in steps:
+            # Steps are told apart by their last key and the last key
+            #  of the step before them, so that e.g. "apps" after
+            #  "shift" is learned separately, and so that the steps of
+            #  each link of a batch are learned together.
+            last_key = key_spec.split(",")[-1].strip()
+            step, previous = (previous, last_key), last_key
+            calibrate = default is not None and config.calibration.enabled
+            if calibrate:
+                before = get_window_state(window.handle)
+            Key(key_spec).execute()
+            if default is None:
+                continue
+            if not calibrate:
+                time.sleep(default)
+                continue
+
+            # If the step shows no effect, the configured delay has
+            #  passed by the time waiting for it gives up.
+            delay = calibrator.get_delay(executable, step, default)
+            elapsed = calibrator.wait_for_change(window.handle, before,
+                                                 max(delay, default))
+            if elapsed is None:
+                continue
+            calibrator.record(executable, step, elapsed)
+            if delay > elapsed:
+                time.sleep(delay - elapsed)
+        return True
+
+
+#---------------------------------------------------------------------------
+# Feature rules which are active only while they are in use.  Commands
+#  for links, searching and text size are kept out of the core command
+#  rule, so that they can be deactivated.  A feature is deactivated
+#  when it hasn't been used for a while, unless it has been used often
+#  enough to stick; it is activated again on demand, when an utterance
+#  in Firefox isn't recognized.  Features can also be switched on and
+#  off by voice; features switched off this way stay off.
+
+class FeatureManager(object):
+
+    def __init__(self):
+        self.rules = {}             # Feature name -> rules.
+        self.uses = {}              # Feature name -> number of uses.
+        self.last_used = {}         # Feature name -> time of last use.
+        self.idle = set()           # Features deactivated for being idle.
+
+    def add(self, name, rule):
+        self.rules.setdefault(name, []).append(rule)
+        self.last_used.setdefault(name, time.time())
+        return rule
+
+    def is_active(self, name):
+        return self.rules[name][0].enabled
+
+    def get_active(self):
+        names = [n for n in self.rules if self.is_active(n)]
+        names.sort()
+        return tuple(names)
+
+    def set_active(self, name, active):
+        self.idle.discard(name)
+        if active:
+            self.last_used[name] = time.time()
+        if self.is_active(name) == active:
+            return
+        start = time.clock()
+        for rule in self.rules[name]:
+            if active: rule.enable()
+            else:      rule.disable()
+        print "%s %s commands in %.1f ms." \
+              % (("Deactivated", "Activated")[active], name,
+                 (time.clock() - start) * 1000)
+
+    def used(self, name):
+        self.uses[name] = self.uses.get(name, 0) + 1
+        self.last_used[name] = time.time()
+
+    def deactivate_idle(self):
+        limit = time.time() - config.features.idle_minutes * 60
+        deactivated = []
+        for name in self.rules:
+            if not self.is_active(name):
+                continue
+            if self.uses.get(name, 0) >= config.features.sticky_uses:
+                continue
+            if self.last_used[name] < limit:
+                self.set_active(name, False)
+                self.idle.add(name)
+                deactivated.append(name)
+        return deactivated
+
+    def activate_idle(self):
+        activated = list(self.idle)
+        for name in activated:
+            self.set_active(name, True)
+        return activated
+
+
+features = FeatureManager()
+
+
+#---------------------------------------------------------------------------
+# Observer which activates idle features on demand and measures the
+#  time from the start of each utterance in Firefox until its result,
+#  grouped by which features were active.  The start is signaled at
+#  the beginning of the utterance, so the times include speaking and
+#  are only meaningful when compared with each other.
+
+class FeatureObserver(RecognitionObserver):
+
+    max_samples = 50
+
+    def __init__(self):
+        RecognitionObserver.__init__(self)
+        self.begin_time = None
+        self.latencies = {}         # Active features -> [seconds].
+
+    def on_begin(self):
+        window = Window.get_foreground()
+        if context.matches(window.executable, window.title, window.handle):
+            self.begin_time = time.clock()
+        else:
+            self.begin_time = None
+
+    def on_recognition(self, words):
+        self._record()
+
+    def on_failure(self):
+        if self.begin_time is None:
+            return
+        self._record()
+        if config.features.wake_on_failure:
+            activated = features.activate_idle()
+            if activated:
+                print "Activated idle %s commands; please repeat." \
+                      % ", ".join(activated)
+                self.report()
+
+    def _record(self):
+        if self.begin_time is None:
+            return
+        elapsed = time.clock() - self.begin_time
+        self.begin_time = None
+        samples = self.latencies.setdefault(features.get_active(), [])
+        samples.append(elapsed)
+        del samples[:-self.max_samples]
+
+    def report(self):
+        keys = self.latencies.keys()
+        keys.sort()
+        for active in keys:
+            samples = self.latencies[active]
+            print "  %s: %.0f ms mean over %d utterances" \
+                  % (", ".join(active) or "no features",
+                     sum(samples) / len(samples) * 1000, len(samples))
+
+
+feature_observer = FeatureObserver()
+
+
+class FeatureRule(MappingRule):
+
+    feature = None
+
+    def _process_recognition(self, node, extras):
+        features.used(self.feature)
+        MappingRule._process_recognition(self, node, extras)
+
+
 #---------------------------------------------------------------------------
 # Create the main command rule.
 
@@ -174,7 +485,6 @@ class CommandRule(MappingRule):
         config.lang.address_bar:        Key("a-d"),
         config.lang.copy_address:       Key("a-d, c-c"),
         config.lang.paste_address:      Key("a-d, c-v, enter"),
-        config.lang.search_bar:         Key("c-k"),
         config.lang.go_home:            Key("a-home"),
         config.lang.stop_loading:       Key("escape"),
         config.lang.toggle_tags:        Key("f12"),
@@ -190,60 +500,108 @@ class CommandRule(MappingRule):
         config.lang.next_tab:           Key("c-tab:%(n)d"),
         config.lang.prev_tab:           Key("cs-tab:%(n)d"),
 
-        config.lang.normal_size:        Key("a-v/20, z/20, r"),
-        config.lang.smaller_size:       Key("c-minus:%(n)d"),
-        config.lang.bigger_size:        Key("cs-equals:%(n)d"),
-
         config.lang.submit:             Key("enter"),
-        config.lang.submit_text:        Text("%(text)s") + Key("enter"),
+        config.lang.submit_text:        FastText("%(text)s") + Key("enter"),
         config.lang.submit_clipboard:   Key("c-v, enter"),
 
         config.lang.find:               Key("c-f"),
-        config.lang.find_text:          Key("c-f") + Text("%(text)s"),
+        config.lang.find_text:          Key("c-f") + FastText("%(text)s"),
         config.lang.find_next:          Key("f3/10:%(n)d"),
+        }
+    extras = [
+        IntegerRef("n", 1, 20),
+        Dictation("text"),
+        ]
+    defaults = {
+        "n": 1,
+        }
+
+
+class TextSizeRule(FeatureRule):
 
+    feature = "text size"
+    mapping = {
+        config.lang.normal_size:        Key("a-v/20, z/20, r"),
+        config.lang.smaller_size:       Key("c-minus:%(n)d"),
+        config.lang.bigger_size:        Key("cs-equals:%(n)d"),
+        }
+    extras = [
+        IntegerRef("n", 1, 20),
+        ]
+    defaults = {
+        "n": 1,
+        }
+
+
+class LinkCommandRule(FeatureRule):
+
+    feature = "links"
+    mapping = {
         config.lang.link_open:          Key("%(link)s, enter"),
-        config.lang.link_save:          Key("%(link)s, shift/10, apps/20, k"),
-        config.lang.link_save_now:      Key("%(link)s, shift/10, apps/20, k")
+        config.lang.link_save:          CalibratedKey("%(link)s, shift/10, apps/20, k"),
+        config.lang.link_save_now:      CalibratedKey("%(link)s, shift/10, apps/20, k")
                                          + WaitWindow(title="Enter name of file")
                                          + Pause("20") + Key("enter"),
         config.lang.link_select:        Key("%(link)s, shift"),
-        config.lang.link_menu:          Key("%(link)s, shift/10, apps"),
-        config.lang.link_force:         Key("%(link)s, shift/10, enter"),
-        config.lang.link_window:        Key("%(link)s, shift/10, apps/20, w"),
-        config.lang.link_tab:           Key("%(link)s, shift/10, apps/20, t"),
-        config.lang.link_copy:          Key("%(link)s, shift/10, apps/20, a"),
-        config.lang.link_copy_into_tab: Key("%(link)s, shift/10, apps/20, a/10, c-t/20, c-v, enter"),
+        config.lang.link_menu:          CalibratedKey("%(link)s, shift/10, apps"),
+        config.lang.link_force:         CalibratedKey("%(link)s, shift/10, enter"),
+        config.lang.link_window:        CalibratedKey("%(link)s, shift/10, apps/20, w"),
+        config.lang.link_tab:           CalibratedKey("%(link)s, shift/10, apps/20, t"),
+        config.lang.link_copy:          CalibratedKey("%(link)s, shift/10, apps/20, a"),
+        config.lang.link_copy_into_tab: CalibratedKey("%(link)s, shift/10, apps/20, a/10, c-t/20, c-v, enter"),
         config.lang.link_list:          Key("%(link)s, enter, a-down"),
-        config.lang.link_submit:        Key("%(link)s, enter/30, enter"),
-        config.lang.link_submit_text:   Key("%(link)s, enter/30")
-                                         + Text("%(text)s") + Key("enter"),
-        config.lang.link_submit_clipboard: Key("%(link)s, enter/30, c-v, enter"),
-        config.lang.link_dictation_box: Key("%(link)s, enter/30, cs-d"),
-        config.lang.link_assign_keyword: Key("%(link)s, enter/10, apps/20, k"),
+        config.lang.link_submit:        CalibratedKey("%(link)s, enter/30, enter"),
+        config.lang.link_submit_text:   CalibratedKey("%(link)s, enter/30")
+                                         + FastText("%(text)s") + Key("enter"),
+        config.lang.link_submit_clipboard: CalibratedKey("%(link)s, enter/30, c-v, enter"),
+        config.lang.link_dictation_box: CalibratedKey("%(link)s, enter/30, cs-d"),
+        config.lang.link_assign_keyword: CalibratedKey("%(link)s, enter/10, apps/20, k"),
+        }
+    extras = [
+        link,
+        Dictation("text"),
+        ]
 
+
+class SearchRule(FeatureRule):
+
+    feature = "search"
+    mapping = {
+        config.lang.search_bar:         Key("c-k"),
         config.lang.search_text:        Key("c-k")
-                                         + Text("%(text)s") + Key("enter"),
+                                         + FastText("%(text)s") + Key("enter"),
         config.lang.search_searchbar_text: Key("c-k, c-up:20, c-down:%(searchbar)d")
-                                         + Text("%(text)s") + Key("enter"),
+                                         + FastText("%(text)s") + Key("enter"),
         config.lang.search_keyword_text: Key("a-d")
-                                         + Text("%(keyword)s %(text)s")
+                                         + FastText("%(keyword)s %(text)s")
                                          + Key("enter"),
         config.lang.search_clipboard:   Key("c-k, c-v, enter"),
         config.lang.search_searchbar_clipboard: Key("c-k, c-up:20, c-down:%(searchbar)d, c-v, enter"),
-        config.lang.search_keyword_clipboard: Key("a-d") + Text("%(keyword)s")
+        config.lang.search_keyword_clipboard: Key("a-d") + FastText("%(keyword)s")
                                          + Key("c-v, enter"),
         }
     extras = [
-        link,
-        IntegerRef("n", 1, 20),
         Dictation("text"),
         Choice("keyword", keywords),
         Choice("searchbar", searchbar),
         ]
-    defaults = {
-        "n": 1,
+
+
+class FeatureControlRule(MappingRule):
+
+    mapping = {
+        config.lang.enable_feature:     Function(features.set_active,
+                                                 active=True),
+        config.lang.disable_feature:    Function(features.set_active,
+                                                 active=False),
         }
+    extras = [
+        Choice("name", {
+                        "link":      "links",
+                        "search":    "search",
+                        "text size": "text size",
+                       }),
+        ]
 
 
 #---------------------------------------------------------------------------
@@ -253,42 +611,155 @@ slide_directions = {
                     "up":    (0,-1),
                     "down":  (0,+1),
                    }
-slide_speeds     = {
-                    "1":     10,
-                    "2":     20,
-                    "3":     30,
-                    "4":     40,
+slide_speeds     = {                # Wheel units per second; one notch
+                    "1":     120,   #  of the mouse wheel is 120 units.
+                    "2":     240,
+                    "3":     480,
+                    "4":     960,
                    }
-slide_default_speed = 15
+slide_default_speed = 180
+slide_speed_factor = 1.5
 slide_start_spec = "(-15,0.6)"
 
-slide_grammar = None
-
-def start_sliding(direction, speed):
-    offset_x = direction[0] * speed
-    offset_y = direction[1] * speed
-    offset_spec = "<%d,%d>" % (offset_x, offset_y)
-    action = Key("escape")
-    action.execute()
-    action = Mouse("%s/25, middle/25, %s" % (slide_start_spec, offset_spec))
-    action.execute()
-
-    global slide_grammar
-    if not slide_grammar:
-        slide_grammar = Grammar("Firefox slide grammar")
-        slide_grammar.add_rule(SlideControlRule())
-        slide_grammar.load()
-        slide_grammar.set_exclusive(True)
 
-def stop_sliding():
-    action = Key("escape")
-    action.execute()
+#---------------------------------------------------------------------------
+# Scroll controller which slides by sending mouse wheel events from its
+#  own thread.  Its velocity follows the target velocity with limited
+#  acceleration, so speed changes are smooth.  Events are sent to a
+#  sink, so that a fake one can be used to measure the event rate and
+#  its jitter.
+
+class WheelSink(object):
+
+    def scroll(self, delta):
+        win32api.mouse_event(win32con.MOUSEEVENTF_WHEEL, 0, 0, delta, 0)
+
+
+class ScrollController(object):
+
+    def __init__(self, sink, rate=50, acceleration=1000):
+        self.sink = sink
+        self.interval = 1.0 / rate
+        self.acceleration = acceleration    # Wheel units per second^2.
+        self.target = 0.0                   # Wheel units per second;
+        self.velocity = 0.0                 #  positive scrolls up.
+        self.event_times = []
+        self._residue = 0.0
+        self._wake = threading.Event()
+        self._running = False
+        self._thread = None
+
+    def set_target(self, velocity):
+        if self.target == 0 and self.velocity == 0:
+            # Starting from rest; the pause since the previous slide
+            #  is not an interval between events.
+            self.event_times = []
+        self.target = float(velocity)
+        self._start()
+        self._wake.set()
+
+    def adjust(self, factor):
+        self.set_target(self.target * factor)
+
+    def stop(self):
+        self.target = 0.0
+        self.velocity = 0.0
+        self._residue = 0.0
+
+    def shutdown(self):
+        self.stop()
+        self._running = False
+        self._wake.set()
+
+    def get_stats(self):
+        # Return the rate of recent events and the standard deviation
+        #  of the intervals between them.
+        times = self.event_times[:]
+        intervals = [b - a for a, b in zip(times, times[1:])]
+        if not intervals:
+            return 0.0, 0.0
+        mean = sum(intervals) / len(intervals)
+        variance = sum([(i - mean) ** 2 for i in intervals]) / len(intervals)
+        return 1 / max(mean, 1e-6), variance ** 0.5
+
+    def _start(self):
+        if self._thread and self._thread.isAlive():
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def _run(self):
+        last = time.time()
+        while self._running:
+            self._wake.clear()
+            if self.target == 0 and self.velocity == 0:
+                self._wake.wait()
+                last = time.time()
+                continue
+            time.sleep(self.interval)
+            now = time.time()
+            self._step(now - last, now)
+            last = now
+
+    def _step(self, elapsed, now):
+        change = self.target - self.velocity
+        limit = self.acceleration * elapsed
+        self.velocity += max(-limit, min(limit, change))
+        self._residue += self.velocity * elapsed
+        delta = int(self._residue)
+        if delta:
+            self._residue -= delta
+            self.sink.scroll(delta)
+            self.event_times.append(now)
+            del self.event_times[:-200]
+
+
+scroll_controller = ScrollController(WheelSink())
 
-    global slide_grammar
-    if slide_grammar:
+
+#---------------------------------------------------------------------------
+# Create the command rules for sliding.  The slide grammar is loaded
+#  together with this module's grammar, with its rule disabled.
+#  Sliding only enables the rule and makes the grammar exclusive,
+#  which is much quicker than loading a grammar.
+
+def set_sliding(active):
+    if slide_control_rule.enabled == active:
+        return
+    start = time.clock()
+    if active:
+        slide_control_rule.enable()
+        slide_grammar.set_exclusive(True)
+    else:
         slide_grammar.set_exclusive(False)
-        slide_grammar.unload()
-        slide_grammar = None
+        slide_control_rule.disable()
+    print "Slide grammar %s in %.1f ms." % (("off", "on")[active],
+                                            (time.clock() - start) * 1000)
+
+def start_sliding(direction, speed=None):
+    if speed is None:
+        speed = abs(scroll_controller.target) or slide_default_speed
+    if not slide_control_rule.enabled:
+        # Wheel events go to the window under the mouse pointer.
+        Mouse(slide_start_spec).execute()
+    scroll_controller.set_target(-direction[1] * speed)
+    set_sliding(True)
+
+def change_speed(factor):
+    scroll_controller.adjust(factor)
+
+def set_speed(speed):
+    if scroll_controller.target < 0: speed = -speed
+    scroll_controller.set_target(speed)
+
+def stop_sliding():
+    scroll_controller.stop()
+    set_sliding(False)
+    rate, jitter = scroll_controller.get_stats()
+    print "Slid at %.1f wheel events/s, jitter %.1f ms." \
+          % (rate, jitter * 1000)
 
 class SlideStartRule(MappingRule):
 
@@ -308,15 +779,17 @@ class SlideControlRule(MappingRule):
 
     mapping  = {
                 "[slide] <direction> [<speed>]":  Function(start_sliding),
+                "faster":                         Function(change_speed,
+                                                           factor=slide_speed_factor),
+                "slower":                         Function(change_speed,
+                                                           factor=1 / slide_speed_factor),
+                "speed <speed>":                  Function(set_speed),
                 "[slide] stop":                   Function(stop_sliding),
                }
     extras   = [
                 Choice("direction", slide_directions),
                 Choice("speed", slide_speeds),
                ]
-    defaults = {
-                "speed": slide_default_speed,
-               }
 
 
 #---------------------------------------------------------------------------
@@ -330,25 +803,62 @@ class TabifyRule(CompoundRule):
     repetitions = Repetition(child=repeat_element, min=0, max=8)
     extras = [Sequence(name="links", children=(link, repetitions))]
 
+    tab_keys = "shift/10, apps/20, t/20"
+
     def _process_recognition(self, node, extras):
+        features.used("links")
+        # Open all links with a single action, so that the keystrokes
+        #  are parsed once and sent as one batch.
         link_nodes = node.get_children_by_name("link")
-        for n in link_nodes:
-            action = Key(n.value()) + Key("shift/10, apps/20, t/20")
-            action.execute()
+        spec = ", ".join(["%s, %s" % (n.value(), self.tab_keys)
+                          for n in link_nodes])
+        CalibratedKey(spec).execute()
 
 
 #---------------------------------------------------------------------------
 # Create and load this module's grammar.
 
+class FirefoxGrammar(Grammar):
+
+    def _process_begin(self, executable, title, handle):
+        if features.deactivate_idle():
+            print "Recognition times by active features:"
+            feature_observer.report()
+
+
 context = AppContext(executable="firefox")
-grammar = Grammar("firefox_general", context=context)
+grammar = FirefoxGrammar("firefox_general", context=context)
 grammar.add_rule(CommandRule())
+grammar.add_rule(FeatureControlRule())
+grammar.add_rule(features.add("text size", TextSizeRule()))
+grammar.add_rule(features.add("links", LinkCommandRule()))
+grammar.add_rule(features.add("links", TabifyRule()))
+grammar.add_rule(features.add("search", SearchRule()))
 grammar.add_rule(SlideStartRule())
-grammar.add_rule(TabifyRule())
+capture_rules(grammar)
+
+load_start = time.clock()
 grammar.load()
+print "Loaded Firefox grammar in %.1f ms." % ((time.clock() - load_start) * 1000)
+
+for name in features.rules:
+    if name not in config.features.active:
+        features.set_active(name, False)
+
+slide_grammar = Grammar("Firefox slide grammar")
+slide_control_rule = SlideControlRule()
+slide_grammar.add_rule(slide_control_rule)
+slide_grammar.load()
+slide_control_rule.disable()
+
+feature_observer.register()
 
 # Unload function which will be called by natlink at unload time.
 def unload():
-    global grammar
+    global grammar, slide_grammar
     if grammar: grammar.unload()
     grammar = None
+    if slide_grammar: slide_grammar.unload()
+    slide_grammar = None
+    feature_observer.unregister()
+    scroll_controller.shutdown()
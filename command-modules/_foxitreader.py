@@ -29,6 +29,7 @@ except ImportError:
 
 from dragonfly import (Grammar, AppContext, MappingRule, Dictation,
                        Key, Text, Config, Section, Item, IntegerRef)
+from textemit import FastText
 
 
 #---------------------------------------------------------------------------
@@ -53,7 +54,7 @@ class CommandRule(MappingRule):
                 "zoom [whole | full] page": Key("c-2"),
                 "zoom [page] width":        Key("c-3"),
 
-                "find <text>":              Key("c-f") + Text("%(text)s")
+                "find <text>":              Key("c-f") + FastText("%(text)s")
            	                                 + Key("f3"),
                 "find next":                Key("f3"),
 
@@ -70,6 +70,7 @@ except ImportError:
     pass
 
 from dragonfly import *
+from textemit import FastText
 
 
 #---------------------------------------------------------------------------
@@ -127,12 +128,13 @@ config.cmd.map    = Item(
      "release control":                  Key("ctrl:up"),
      "release [all]":                    release,
 
-     "say <text>":                       release + Text("%(text)s"),
+     "say <text>":                       release + FastText("%(text)s"),
      "mimic <text>":                     release + Mimic(extra="text"),
     },
     namespace={
      "Key":   Key,
      "Text":  Text,
+     "FastText": FastText,
     }
 )
 namespace = config.load()
@@ -154,7 +156,7 @@ if namespace:
         def wrap_function(function):
             def _function(dictation):
                 formatted_text = function(dictation)
-                Text(formatted_text).execute()
+                FastText(formatted_text, static=True).execute()
             return Function(_function)
 
         action = wrap_function(function)
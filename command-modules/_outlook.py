@@ -20,11 +20,20 @@ Command: **"(folder | show me) <folder>"**
 Command: **"move to <folder>"**
     Move the selected item(s) to the specified folder.
 
+Command: **"find (mail | email) about <text>"**
+    Select the newest message whose subject or sender contains
+    all of the spoken words.  Message headers are indexed in the
+    background, so this search doesn't wait for Outlook.
+
 Command: **"save attachments"**
-    Save all attachments of selected items.
+    Save all attachments of selected items.  Attachments with the
+    same filename are given unique names, and attachments with
+    identical content are saved only once.
 
 Command: **"open attachment <n>"**
     Open attachment number <n> within the selected item.
+    Opened attachments are kept in a disk cache, so that opening
+    the same attachment again does not save it again.
 
 Command: **"[create] new <type>"**
     Creates a new item of the specified type.
@@ -32,12 +41,22 @@ Command: **"[create] new <type>"**
 Command: **"(synchronize | update) (folders | folder list)"**
     Update this module's internal list of Outlook folders.
 
+Command: **"retrieve Outlook contacts"**
+    Refresh this module's index of contacts in the background.
+    The index is also refreshed automatically when it is older
+    than the configured ``contacts.refresh_hours``.  Names in
+    the index can be used as recipients of the commands below.
+
 Command: **"new (email | mail) [to <addresses>]"**
     Create a new mail item.
 
 Command: **"forward [email | mail] [to <addresses>]"**
     Forward to a selected mail item.
 
+The *<addresses>* extra of these commands is a series of contact
+names, optionally separated by "and".  A first name is sufficient
+if it belongs to only one contact.
+
 Commands for responding to a meeting request:
      - **"accept and send"**
      - **"accept and edit"**
@@ -59,9 +78,54 @@ import tempfile
 import os
 import os.path
 import subprocess
-from win32com.client  import constants, gencache
+import shutil
+import threading
+import time
+import Queue
+import re
+import codecs
+import bisect
+import marshal
+from array import array
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+from win32com.client  import constants, gencache, Dispatch
 from pywintypes       import com_error
 from dragonfly        import *
+from comtools         import (collection_iter, collection_values,
+                              profile_rules, profile_application)
+from refreshtools     import BackgroundRefresher, replace_file
+
+
+#---------------------------------------------------------------------------
+# Meeting request responses which use Outlook's object model directly,
+#  instead of navigating its user interface by keystrokes.
+
+class Respond(object):
+
+    modes = ("send", "edit", "none")
+
+    def __init__(self, response, mode):
+        assert mode in self.modes
+        self.response = response
+        self.mode = mode
+
+    def __repr__(self):
+        return "%s(%r, %r)" % (self.__class__.__name__,
+                               self.response, self.mode)
+
+    def respond(self, item):
+        # Respond without user interface; the returned response item
+        #  is then sent, displayed for editing, or discarded.
+        appointment = item.GetAssociatedAppointment(True)
+        response = getattr(constants, self.response)
+        response_item = appointment.Respond(response, True)
+        if self.mode == "send":
+            response_item.Send()
+        elif self.mode == "edit":
+            response_item.Display()
 
 
 #---------------------------------------------------------------------------
@@ -80,32 +144,548 @@ config.lang.item_type_task  = Item("task")
 config.lang.new_email       = Item("new (email | mail) [to <addresses>]")
 config.lang.forward_email   = Item("forward [email | mail] [to <addresses>]")
 config.lang.address_and_word = Item("[and]")
+config.lang.retrieve_contacts = Item("retrieve Outlook contacts")
+config.lang.find_mail       = Item("find (mail | email) about <text>")
 config.lang.meeting_request_actions = Item({
-      "accept and send":             Key("a-a/10, c/20, s/10, enter"),
-      "accept and edit":             Key("a-a/10, c/20, e/10, enter"),
-      "accept without response":     Key("a-a/10, c/20, d/10, enter"),
-      "decline and send":            Key("a-a/10, e/20, s/10, enter"),
-      "decline and edit":            Key("a-a/10, e/20, e/10, enter"),
-      "decline without response":    Key("a-a/10, e/20, d/10, enter"),
-      "tentative and send":          Key("a-a/10, a/20, s/10, enter"),
-      "tentative and edit":          Key("a-a/10, a/20, e/10, enter"),
-      "tentative without response":  Key("a-a/10, a/20, d/10, enter"),
+      "accept and send":             Respond("olMeetingAccepted", "send"),
+      "accept and edit":             Respond("olMeetingAccepted", "edit"),
+      "accept without response":     Respond("olMeetingAccepted", "none"),
+      "decline and send":            Respond("olMeetingDeclined", "send"),
+      "decline and edit":            Respond("olMeetingDeclined", "edit"),
+      "decline without response":    Respond("olMeetingDeclined", "none"),
+      "tentative and send":          Respond("olMeetingTentative", "send"),
+      "tentative and edit":          Respond("olMeetingTentative", "edit"),
+      "tentative without response":  Respond("olMeetingTentative", "none"),
       "check calendar":              Key("a-a/10, h"),
-     }, namespace={"Key": Key})
+     }, namespace={"Key": Key, "Respond": Respond})
+config.attachments          = Section("Attachments section")
+config.attachments.writer_threads = Item(4, doc="Number of threads used to hash and store saved attachments.")
+config.attachments.report_threshold = Item(10, doc="Minimum number of attachments for which throughput of each stage is reported.")
+config.attachments.cache_directory = Item(os.path.join(tempfile.gettempdir(), "outlook-attachment-cache"), doc="Directory in which opened attachments are cached.")
+config.attachments.cache_quota = Item(200 * 1024 * 1024, doc="Maximum number of bytes used by the attachment cache.")
+config.attachments.stale_days = Item(7, doc="Age in days after which directories of saved attachments are removed.")
 config.contacts             = Section("Contacts section")
 config.contacts.addresses   = Item({
       "someone": "someone@example.com",
      })
+config.contacts.index_path  = Item(os.path.splitext(os.path.abspath(__file__))[0] + "-contacts.dat", doc="File in which the index of Outlook contacts is stored.")
+config.contacts.page_size   = Item(200, doc="Number of address entry IDs retrieved per batch while indexing.")
+config.contacts.max_recipients = Item(5, doc="Maximum number of recipients which can be spoken in one command.")
+config.contacts.refresh_hours = Item(24, doc="Minimum number of hours between automatic refreshes of the contacts index.")
+config.mail_index           = Section("Mail index section")
+config.mail_index.path      = Item(os.path.splitext(os.path.abspath(__file__))[0] + "-mail.dat", doc="File in which the index of message headers is stored.")
+config.mail_index.refresh_minutes = Item(5, doc="Minimum number of minutes between indexing new messages.")
+config.mail_index.reconcile_hours = Item(12, doc="Minimum number of hours between detecting moved and deleted messages.")
 #config.generate_config_file()
 config.load()
 
 
 #---------------------------------------------------------------------------
-# Utility generator function for iterating over COM collections.
+# Index of the names and SMTP addresses of Outlook's address entries.
+#  The index is stored on disk as one tab-separated line per entry, so
+#  that it can be loaded quickly at startup.  It is refreshed by a
+#  worker thread which pages through the address lists and only looks
+#  up the SMTP address of entries which are not yet known.
+
+name_comment_pattern = re.compile(r"\(.*?\)|\[.*?\]|<.*?>")
+name_invalid_pattern = re.compile(r"[^\w\s'-]", re.UNICODE)
+
+def spoken_name(name):
+    # Convert a display name such as "Doe, John (Sales)" to "John Doe".
+    name = name_comment_pattern.sub(" ", name)
+    if name.count(",") == 1:
+        last, first = name.split(",")
+        name = first + " " + last
+    name = name_invalid_pattern.sub(" ", name)
+    return " ".join(name.split())
+
+
+class ContactIndex(BackgroundRefresher):
+
+    uses_com = True
+
+    def __init__(self, path, page_size):
+        BackgroundRefresher.__init__(self)
+        self.path = path
+        self.page_size = page_size
+        self.entries = {}           # Entry ID -> (name, address).
+
+    def load(self):
+        if not os.path.isfile(self.path):
+            return
+        entries = {}
+        f = codecs.open(self.path, "r", "utf-8")
+        try:
+            for line in f:
+                fields = line.rstrip("\r\n").split("\t")
+                if len(fields) == 3:
+                    entries[fields[0]] = (fields[1], fields[2])
+        finally:
+            f.close()
+        self.entries = entries
+
+    def save(self, entries):
+        temp_path = self.path + ".tmp"
+        f = codecs.open(temp_path, "w", "utf-8")
+        try:
+            for entry_id, (name, address) in entries.iteritems():
+                f.write(u"%s\t%s\t%s\n" % (entry_id, name, address))
+        finally:
+            f.close()
+        replace_file(temp_path, self.path)
+
+    def get_age(self):
+        if not os.path.isfile(self.path):
+            return None
+        return time.time() - os.path.getmtime(self.path)
+
+    def get_mapping(self):
+        mapping = {}
+        for name, address in self.entries.itervalues():
+            spoken = spoken_name(name)
+            if spoken:
+                mapping[spoken] = address
+        return mapping
+
+    #-----------------------------------------------------------------------
+    # Methods for refreshing the index in the background.
+
+    def apply_pending(self, entries):
+        self.entries = entries
+
+    def refresh(self):
+        try:
+            start = time.time()
+            entries = self._retrieve_entries()
+            self.save(entries)
+            self.set_pending(entries)
+            print "Indexed %d Outlook contacts in %.1fs." \
+                  % (len(entries), time.time() - start)
+        except (com_error, IOError, OSError), e:
+            print "Failed to index Outlook contacts: %s" % (e,)
+
+    def _retrieve_entries(self):
+        known = self.entries
+        entries = {}
+        application = Dispatch("Outlook.Application")
+        namespace = application.GetNamespace("MAPI")
+        for address_list in collection_iter(namespace.AddressLists, 1):
+            # Only the ID of each entry is prefetched; the name and
+            #  address are only retrieved for entries not yet known.
+            values = collection_values(address_list.AddressEntries,
+                                       ("ID",), 1, self.page_size,
+                                       with_item=True)
+            for entry, entry_id in values:
+                if entry_id in known:
+                    entries[entry_id] = known[entry_id]
+                    continue
+                try:
+                    name = entry.Name
+                except com_error:
+                    continue
+                address = self._get_smtp_address(entry)
+                if address and "@" in address:
+                    entries[entry_id] = (name, address)
+        return entries
+
+    def _get_smtp_address(self, entry):
+        exchange_types = (getattr(constants, "olExchangeUserAddressEntry", 0),
+                          getattr(constants, "olExchangeRemoteUserAddressEntry", 5))
+        try:
+            if entry.AddressEntryUserType in exchange_types:
+                user = entry.GetExchangeUser()
+                if user:
+                    return user.PrimarySmtpAddress
+            return entry.Address
+        except com_error:
+            return None
+
+
+contact_index = ContactIndex(config.contacts.index_path,
+                             config.contacts.page_size)
+contact_index.load()
+
+#---------------------------------------------------------------------------
+# In-memory index used to resolve spoken names to addresses after
+#  recognition.  Recognized names are always spoken forms from the
+#  contacts list, so they are matched exactly, or by prefix for the
+#  unambiguous first names which the list also contains.
+
+class ContactResolver(object):
+
+    def __init__(self):
+        self.set({})
+
+    def set(self, mapping):
+        self._exact = {}
+        for spoken, address in mapping.iteritems():
+            self._exact[spoken.lower()] = address
+        self._sorted = self._exact.keys()
+        self._sorted.sort()
+
+    def get_first_names(self):
+        # Returns a mapping of unambiguous first names to addresses.
+        first_names = {}
+        for key, address in self._exact.iteritems():
+            first = key.split()[0]
+            if first in first_names and first_names[first] != address:
+                first_names[first] = None
+            else:
+                first_names[first] = address
+        return dict([(k, v) for k, v in first_names.iteritems() if v])
+
+    def resolve(self, spoken):
+        key = " ".join(spoken.lower().split())
+        if key in self._exact:
+            return self._exact[key]
+
+        candidates = self._find_prefix(key + " ")
+        if not candidates:
+            return None
+        if len(candidates) > 1:
+            print "Ambiguous recipient %r; using %r out of %r." \
+                  % (spoken, candidates[0], candidates)
+        return self._exact[candidates[0]]
+
+    def _find_prefix(self, prefix):
+        candidates = []
+        index = bisect.bisect_left(self._sorted, prefix)
+        while index < len(self._sorted) \
+                and self._sorted[index].startswith(prefix):
+            candidates.append(self._sorted[index])
+            index += 1
+        return candidates
+
+
+#---------------------------------------------------------------------------
+# Contacts available by voice; configured addresses take precedence
+#  over addresses retrieved from Outlook.  The spoken forms of the
+#  contacts are shared by all recipient elements through a single
+#  list, so that updating contacts doesn't require rebuilding rules.
+
+contacts = DictList("contacts")
+contact_resolver = ContactResolver()
+
+def update_contacts():
+    mapping = contact_index.get_mapping()
+    mapping.update(config.contacts.addresses)
+    contact_resolver.set(mapping)
+    spoken_forms = contact_resolver.get_first_names()
+    spoken_forms.update(mapping)
+    contacts.set(spoken_forms)
+
+update_contacts()
+
+
+#---------------------------------------------------------------------------
+# Utility generator function for walking a tree of Outlook folders.
+
+def iter_folders(root_folder):
+    stack = [collection_iter(root_folder.Folders, 1)]
+    while stack:
+        try:
+            folder = stack[-1].next()
+        except StopIteration:
+            stack.pop()
+            continue
+        yield folder
+        stack.append(collection_iter(folder.Folders, 1))
+
+
+#---------------------------------------------------------------------------
+# Local inverted index over the headers of messages.  Each document
+#  is a tuple of (entry ID, store ID, subject, sender, received time,
+#  folder path); each word of a subject or sender maps to the list
+#  of documents containing it.  Folders are indexed incrementally
+#  by remembering the latest received time seen in each folder.
+#  Removed documents are left as None until the index is saved.
+
+word_pattern = re.compile(r"\w\w+", re.UNICODE)
+
+def index_words(text):
+    return word_pattern.findall(text.lower())
+
+
+def document_words(document):
+    return set(index_words(document[2]) + index_words(document[3]))
+
+
+class MailIndex(object):
+
+    version = 1
+
+    def __init__(self):
+        self.documents = []
+        self.marks = {}             # Folder path -> latest received time.
+        self._postings = {}         # Word -> array of document numbers.
+        self._entry_ids = {}        # Entry ID -> document number.
+        self._removed = 0
+
+    def add(self, entry_id, store_id, subject, sender, received, folder):
+        number = self._entry_ids.get(entry_id)
+        document = (entry_id, store_id, subject, sender, received, folder)
+        if number is not None:
+            if self.documents[number] == document:
+                return
+            self._unindex(number)
+        else:
+            number = len(self.documents)
+            self.documents.append(None)
+            self._entry_ids[entry_id] = number
+        self.documents[number] = document
+        for word in document_words(document):
+            postings = self._postings.get(word)
+            if postings is None:
+                postings = self._postings[word] = array("i")
+            postings.append(number)
+
+    def remove(self, entry_id):
+        number = self._entry_ids.pop(entry_id, None)
+        if number is None:
+            return False
+        self._unindex(number)
+        self.documents[number] = None
+        self._removed += 1
+        return True
+
+    def _unindex(self, number):
+        for word in document_words(self.documents[number]):
+            postings = self._postings[word]
+            postings.remove(number)
+            if not postings:
+                del self._postings[word]
+
+    def get_entry_ids(self, folder):
+        return set([d[0] for d in self.documents
+                    if d is not None and d[5] == folder])
+
+    def remove_folders(self, folders):
+        # Remove the documents and marks of folders not in *folders*.
+        for document in self.documents:
+            if document is not None and document[5] not in folders:
+                self.remove(document[0])
+        for folder in self.marks.keys():
+            if folder not in folders:
+                del self.marks[folder]
+
+    def search(self, text, limit=10):
+        # Return the newest documents which contain all spoken words.
+        words = set(index_words(text))
+        if not words:
+            return []
+        postings = [self._postings.get(word) for word in words]
+        if None in postings:
+            return []
+        postings.sort(key=len)
+        numbers = set(postings[0])
+        for other in postings[1:]:
+            numbers.intersection_update(other)
+        documents = [self.documents[n] for n in numbers]
+        documents.sort(key=lambda d: d[4], reverse=True)
+        return documents[:limit]
+
+    def compact(self):
+        # Renumber the documents so that removed ones are dropped.
+        documents = [d for d in self.documents if d is not None]
+        self.documents = []
+        self._postings = {}
+        self._entry_ids = {}
+        self._removed = 0
+        for document in documents:
+            self.add(*document)
+
+    def save(self, path):
+        if self._removed:
+            self.compact()
+        postings = dict([(word, numbers.tostring())
+                         for word, numbers in self._postings.iteritems()])
+        data = (self.version, self.documents, self.marks, postings)
+        temp_path = path + ".tmp"
+        f = open(temp_path, "wb")
+        try:
+            marshal.dump(data, f)
+        finally:
+            f.close()
+        replace_file(temp_path, path)
+
+    def load(self, path):
+        if not os.path.isfile(path):
+            return
+        f = open(path, "rb")
+        try:
+            data = marshal.load(f)
+        finally:
+            f.close()
+        if data[0] != self.version:
+            return
+        self.documents, self.marks = list(data[1]), data[2]
+        self._postings = {}
+        for word, numbers in data[3].iteritems():
+            self._postings[word] = array("i", numbers)
+        self._entry_ids = dict([(d[0], n)
+                                for n, d in enumerate(self.documents)])
+        self._removed = 0
+
+
+def com_time(value):
+    return time.mktime(value.timetuple())
+
+
+def get_header(item, store_id, folder_path):
+    # Return the header tuple of a message, or None if *item* is not
+    #  a message, e.g. a report.
+    try:
+        return (item.EntryID, store_id, item.Subject or u"",
+                item.SenderName or u"", com_time(item.ReceivedTime),
+                folder_path)
+    except (AttributeError, com_error):
+        return None
+
+
+def harvest_folder(folder, mark):
+    # Yield header tuples of the messages in *folder* which were
+    #  received after *mark*.  Restrict() has a resolution of one
+    #  minute, so messages before *mark* are filtered out here too.
+    items = folder.Items
+    if mark:
+        since = time.strftime("%m/%d/%Y %I:%M %p", time.localtime(mark))
+        items = items.Restrict("[ReceivedTime] >= '%s'" % since)
+    folder_path = folder.FolderPath
+    store_id = folder.StoreID
+    for item in collection_iter(items, 1):
+        header = get_header(item, store_id, folder_path)
+        if header and header[4] > mark:
+            yield header
+
+
+def reconcile_folder(folder, known):
+    # Return (header tuples of messages not in *known*, entry IDs in
+    #  *known* which are no longer in *folder*).  Only the entry ID
+    #  of messages already known is retrieved.
+    folder_path = folder.FolderPath
+    store_id = folder.StoreID
+    values = collection_values(folder.Items, ("EntryID",), 1,
+                               with_item=True)
+    headers = []
+    present = set()
+    for item, entry_id in values:
+        if entry_id in known:
+            present.add(entry_id)
+            continue
+        header = get_header(item, store_id, folder_path)
+        if header:
+            headers.append(header)
+    return headers, known - present
+
+
+class MailIndexer(BackgroundRefresher):
+
+    uses_com = True
+
+    def __init__(self, path):
+        BackgroundRefresher.__init__(self)
+        self.path = path
+        self.index = MailIndex()
+        self._last_refresh = 0
+        self._last_reconcile = 0
+
+    def load(self):
+        try:
+            self.index.load(self.path)
+        except (IOError, EOFError, ValueError, TypeError), e:
+            print "Failed to load mail index %r: %s" % (self.path, e)
+
+    def search(self, text):
+        self._lock.acquire()
+        try:
+            return self.index.search(text)
+        finally:
+            self._lock.release()
+
+    def remove(self, entry_id):
+        self._lock.acquire()
+        try:
+            return self.index.remove(entry_id)
+        finally:
+            self._lock.release()
+
+    def refresh_due(self, minutes):
+        return time.time() - self._last_refresh > minutes * 60
+
+    def start_refresh(self, reconcile_hours=None):
+        # Index new messages; if *reconcile_hours* have passed since
+        #  the last reconciliation, also detect moved and deleted ones.
+        if self.refreshing:
+            return False
+        now = time.time()
+        reconcile = reconcile_hours is not None \
+                    and now - self._last_reconcile > reconcile_hours * 3600
+        self._last_refresh = now
+        if reconcile:
+            self._last_reconcile = now
+        return BackgroundRefresher.start_refresh(self, reconcile)
+
+    def refresh(self, reconcile):
+        try:
+            start = time.time()
+            application = Dispatch("Outlook.Application")
+            namespace = application.GetNamespace("MAPI")
+            inbox = namespace.GetDefaultFolder(constants.olFolderInbox)
+            added = removed = 0
+            folder_paths = set()
+            for folder in iter_folders(inbox.Parent):
+                if folder.DefaultItemType != constants.olMailItem:
+                    continue            # Calendar, contacts, etc.
+                folder_path = folder.FolderPath
+                folder_paths.add(folder_path)
+                if reconcile:
+                    self._lock.acquire()
+                    try:
+                        known = self.index.get_entry_ids(folder_path)
+                    finally:
+                        self._lock.release()
+                    headers, gone = reconcile_folder(folder, known)
+                else:
+                    mark = self.index.marks.get(folder_path, 0)
+                    headers = list(harvest_folder(folder, mark))
+                    gone = ()
+                self._lock.acquire()
+                try:
+                    for entry_id in gone:
+                        self.index.remove(entry_id)
+                    for header in headers:
+                        self.index.add(*header)
+                    self._update_mark(folder_path, headers, start)
+                finally:
+                    self._lock.release()
+                added += len(headers)
+                removed += len(gone)
+            self._lock.acquire()
+            try:
+                if reconcile:
+                    self.index.remove_folders(folder_paths)
+                self.index.save(self.path)
+            finally:
+                self._lock.release()
+            print "Indexed %d new and removed %d old messages in %.1fs." \
+                  % (added, removed, time.time() - start)
+        except (com_error, IOError, OSError), e:
+            print "Failed to index messages: %s" % (e,)
+
+    def _update_mark(self, folder_path, headers, start):
+        # Folders in which nothing was found are marked with the time
+        #  at which this refresh started, so that they are not
+        #  enumerated in full again.
+        marks = self.index.marks
+        mark = marks.get(folder_path, 0)
+        for header in headers:
+            mark = max(mark, header[4])
+        marks[folder_path] = mark or start
+
+
+mail_indexer = MailIndexer(config.mail_index.path)
+mail_indexer.load()
 
-def collection_iter(collection):
-    for index in xrange(1, collection.Count + 1):
-        yield collection.Item(index)
 
 #---------------------------------------------------------------------------
 # This module's main grammar.
@@ -124,8 +704,30 @@ class ControlGrammar(ConnectionGrammar):
 
     def connection_up(self):
         # Made connection with Outlook -> retrieves available folders.
+        profile_application(self)
         self.update_folders()
 
+        # Index messages received since the last refresh, and detect
+        #  moved and deleted messages if that hasn't been done lately.
+        mail_indexer.start_refresh(config.mail_index.reconcile_hours)
+
+        # Refresh the contacts index in the background if it is old.
+        age = contact_index.get_age()
+        if age is None or age > config.contacts.refresh_hours * 3600:
+            contact_index.start_refresh()
+
+    def _process_begin(self, executable, title, handle):
+        # Apply newly indexed contacts; the contacts list must be
+        #  updated from this thread, not the indexing thread.
+        if contact_index.pop_pending() is not None:
+            update_contacts()
+
+        # Index messages which arrived while Outlook stayed connected.
+        if self.application \
+                and mail_indexer.refresh_due(config.mail_index.refresh_minutes):
+            mail_indexer.start_refresh(config.mail_index.reconcile_hours)
+        ConnectionGrammar._process_begin(self, executable, title, handle)
+
     def connection_down(self):
         # Lost connection with Outlook -> empty folders list.
         self.reset_folders()
@@ -135,15 +737,8 @@ class ControlGrammar(ConnectionGrammar):
         inbox_folder = namespace.GetDefaultFolder(constants.olFolderInbox)
         root_folder = inbox_folder.Parent
         self.folders.set({})
-        stack = [collection_iter(root_folder.Folders)]
-        while stack:
-            try:
-                folder = stack[-1].next()
-            except StopIteration:
-                stack.pop()
-                continue
+        for folder in iter_folders(root_folder):
             self.folders[folder.Name] = folder
-            stack.append(collection_iter(folder.Folders))
 
     def reset_folders(self):
         self.folders.set({})
@@ -210,7 +805,7 @@ class MoveToFolderRule(CompoundRule):
         if not explorer: return
 
         # Move the selected items to the given folder.
-        for item in collection_iter(explorer.Selection):
+        for item in collection_iter(explorer.Selection, 1):
             self._log.debug("%s: moving item %r to folder %r."
                             % (self, item.Subject, folder.Name))
             item.Move(folder)
@@ -220,6 +815,192 @@ grammar.add_rule(MoveToFolderRule())
 
 #---------------------------------------------------------------------------
 
+class FindMailRule(CompoundRule):
+
+    spec = config.lang.find_mail
+    extras = [Dictation("text")]
+
+    def _process_recognition(self, node, extras):
+        text = unicode(extras["text"])
+        hits = mail_indexer.search(text)
+        if not hits:
+            print "No messages found about %r." % text
+            return
+        for hit in hits:
+            print "  %s: %r from %r" % (hit[5], hit[2], hit[3])
+        entry_id, store_id = hits[0][:2]
+
+        # Get the currently active explorer.
+        explorer = self.grammar.get_active_explorer()
+        if not explorer: return
+
+        # Show the newest message in its folder, or open it if the
+        #  explorer cannot select it directly.
+        namespace = self.grammar.application.GetNamespace("MAPI")
+        try:
+            item = namespace.GetItemFromID(entry_id, store_id)
+        except com_error:
+            print "Message %r is no longer available." % hits[0][2]
+            mail_indexer.remove(entry_id)
+            return
+        try:
+            explorer.SelectFolder(item.Parent)
+            explorer.ClearSelection()
+            explorer.AddToSelection(item)
+        except (AttributeError, com_error):
+            item.Display()
+
+grammar.add_rule(FindMailRule())
+
+
+#---------------------------------------------------------------------------
+
+# Pipeline for extracting the attachments of many items at once.
+#  Attachments are enumerated and saved on the calling thread,
+#  because the COM objects involved belong to that thread.  Each
+#  attachment is saved into a staging directory and then handed
+#  to a pool of writer threads, which hash its content, discard
+#  duplicates and move it to a unique filename in the output
+#  directory.
+
+class AttachmentPipeline(object):
+
+    staging_name = "~staging"
+    hash_block_size = 64 * 1024
+
+    def __init__(self, directory, writer_threads):
+        self.directory = directory
+        self.staging_directory = os.path.join(directory, self.staging_name)
+        os.mkdir(self.staging_directory)
+        self._queue = Queue.Queue()
+        self._lock = threading.Lock()
+        self._digests = {}
+        self._names = set()
+        self.staged = 0
+        self._staged_bytes = 0
+        self._stage_time = 0.0
+        self._stored = 0
+        self._stored_bytes = 0
+        self._duplicates = 0
+        self._write_time = 0.0
+        self._drain_time = 0.0
+        self._threads = []
+        for index in range(max(1, writer_threads)):
+            thread = threading.Thread(target=self._writer)
+            thread.setDaemon(True)
+            thread.start()
+            self._threads.append(thread)
+
+    def add(self, attachment):
+        # Save the attachment to its own staging path, so that
+        #  attachments with the same filename never collide.
+        start = time.time()
+        filename = os.path.basename(attachment.FileName)
+        staging_path = os.path.join(self.staging_directory,
+                                    "%d" % self.staged)
+        attachment.SaveAsFile(staging_path)
+        self._stage_time += time.time() - start
+        self.staged += 1
+        self._staged_bytes += os.path.getsize(staging_path)
+        self._queue.put((staging_path, filename))
+
+    def close(self):
+        # Wait for the writer threads to finish and clean up.
+        start = time.time()
+        for thread in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._drain_time = time.time() - start
+        shutil.rmtree(self.staging_directory, ignore_errors=True)
+
+    def report(self):
+        def rate(count, seconds):
+            if seconds <= 0: return 0.0
+            return count / seconds
+        lines = [
+            "Saved %d attachments into %s:" % (self.staged, self.directory),
+            "  COM save stage: %d files, %d bytes in %.2fs (%.1f files/s, %.1f KB/s)"
+            % (self.staged, self._staged_bytes, self._stage_time,
+               rate(self.staged, self._stage_time),
+               rate(self._staged_bytes / 1024.0, self._stage_time)),
+            "  writer stage:   %d files, %d bytes in %.2fs (%.1f files/s, %.1f KB/s),"
+            " %d duplicates discarded"
+            % (self._stored, self._stored_bytes, self._write_time,
+               rate(self._stored, self._write_time),
+               rate(self._stored_bytes / 1024.0, self._write_time),
+               self._duplicates),
+            "  writer backlog after enumeration: %.2fs" % self._drain_time,
+            ]
+        return "\n".join(lines)
+
+    def _writer(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            start = time.time()
+            staging_path, filename = job
+            try:
+                self._store(staging_path, filename)
+            except (IOError, OSError), e:
+                print "Failed to store attachment %r: %s" % (filename, e)
+            elapsed = time.time() - start
+            self._lock.acquire()
+            try:
+                self._write_time += elapsed
+            finally:
+                self._lock.release()
+
+    def _store(self, staging_path, filename):
+        digest = self._hash(staging_path)
+        size = os.path.getsize(staging_path)
+
+        self._lock.acquire()
+        try:
+            if digest in self._digests:
+                self._duplicates += 1
+                path = None
+            else:
+                path = self._reserve_path(filename)
+                self._digests[digest] = path
+                self._stored += 1
+                self._stored_bytes += size
+        finally:
+            self._lock.release()
+
+        if path is None:
+            os.remove(staging_path)
+        else:
+            os.rename(staging_path, path)
+
+    def _hash(self, path):
+        digest = sha1()
+        f = open(path, "rb")
+        try:
+            while True:
+                block = f.read(self.hash_block_size)
+                if not block:
+                    break
+                digest.update(block)
+        finally:
+            f.close()
+        return digest.digest()
+
+    def _reserve_path(self, filename):
+        # Must be called with the lock held.
+        base, extension = os.path.splitext(filename)
+        candidate = filename
+        counter = 1
+        while os.path.normcase(candidate) in self._names:
+            counter += 1
+            candidate = "%s (%d)%s" % (base, counter, extension)
+        self._names.add(os.path.normcase(candidate))
+        return os.path.join(self.directory, candidate)
+
+
+save_directory_prefix = "outlook-attachments-"
+
 class SaveAttachmentsRule(CompoundRule):
 
     spec = config.lang.save_attachments
@@ -231,17 +1012,20 @@ class SaveAttachmentsRule(CompoundRule):
         if not explorer: return
 
         # Save the attachments of the selected items.
-        temp_dir = tempfile.mkdtemp()
+        temp_dir = tempfile.mkdtemp(prefix=save_directory_prefix)
         print "temporary directory:", temp_dir
-        for item in collection_iter(explorer.Selection):
-            self._log.debug("%s: saving attachments of item %r."
-                            % (self, item.Subject))
-
-            for attachment in collection_iter(item.Attachments):
-                print "attachment %r" % attachment.FileName
-                filename = os.path.basename(attachment.FileName)
-                path = os.path.join(temp_dir, filename)
-                attachment.SaveAsFile(path)
+        pipeline = AttachmentPipeline(temp_dir,
+                                      config.attachments.writer_threads)
+        try:
+            for item in collection_iter(explorer.Selection, 1):
+                self._log.debug("%s: saving attachments of item %r."
+                                % (self, item.Subject))
+                for attachment in collection_iter(item.Attachments, 1):
+                    pipeline.add(attachment)
+        finally:
+            pipeline.close()
+        if pipeline.staged >= config.attachments.report_threshold:
+            print pipeline.report()
 
         # Open a file browser to the containing directory.
         subprocess.Popen(["explorer", temp_dir])
@@ -249,6 +1033,107 @@ class SaveAttachmentsRule(CompoundRule):
 grammar.add_rule(SaveAttachmentsRule())
 
 
+#---------------------------------------------------------------------------
+# Disk-backed cache of opened attachments.  Each attachment is stored in
+#  its own directory, named after the item's EntryID, the attachment's
+#  index and its size.  The modification time of that directory records
+#  when it was last used, so that the least recently used attachments
+#  can be evicted once the cache grows beyond its quota.
+
+class AttachmentCache(object):
+
+    def __init__(self, directory, quota):
+        self.directory = directory
+        self.quota = quota
+        self._entries = None
+
+    def get_path(self, item, index, attachment):
+        try:
+            size = attachment.Size
+        except (AttributeError, com_error):
+            size = -1
+        key = "%s:%d:%d" % (item.EntryID, index, size)
+        name = sha1(str(key)).hexdigest()[:20]
+        filename = os.path.basename(attachment.FileName)
+        entry_directory = os.path.join(self.directory, name)
+        path = os.path.join(entry_directory, filename)
+
+        entries = self._get_entries()
+        if name in entries and os.path.isfile(path):
+            # Cache hit -> mark entry as most recently used.
+            os.utime(entry_directory, None)
+            entries[name][1] = time.time()
+            return path
+
+        # Cache miss -> save attachment into a fresh entry.
+        if os.path.isdir(entry_directory):
+            shutil.rmtree(entry_directory, ignore_errors=True)
+        os.makedirs(entry_directory)
+        attachment.SaveAsFile(path)
+        entries[name] = [os.path.getsize(path), time.time()]
+        self._evict(keep=name)
+        return path
+
+    def _get_entries(self):
+        if self._entries is not None:
+            return self._entries
+        self._entries = {}
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        for name in os.listdir(self.directory):
+            entry_directory = os.path.join(self.directory, name)
+            if not os.path.isdir(entry_directory):
+                continue
+            size = 0
+            for filename in os.listdir(entry_directory):
+                size += os.path.getsize(os.path.join(entry_directory,
+                                                     filename))
+            last_used = os.path.getmtime(entry_directory)
+            self._entries[name] = [size, last_used]
+        return self._entries
+
+    def _evict(self, keep):
+        entries = self._entries
+        total = sum([size for size, last_used in entries.values()])
+        if total <= self.quota:
+            return
+        names = [(last_used, name)
+                 for name, (size, last_used) in entries.items()]
+        names.sort()
+        for last_used, name in names:
+            if total <= self.quota:
+                break
+            if name == keep:
+                continue
+            shutil.rmtree(os.path.join(self.directory, name),
+                          ignore_errors=True)
+            total -= entries.pop(name)[0]
+
+
+attachment_cache = AttachmentCache(config.attachments.cache_directory,
+                                   config.attachments.cache_quota)
+
+
+#---------------------------------------------------------------------------
+# Garbage collection of directories left behind by "save attachments".
+
+def remove_stale_directories(prefix, max_age):
+    directory = tempfile.gettempdir()
+    threshold = time.time() - max_age
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if not name.startswith(prefix) or not os.path.isdir(path):
+            continue
+        if os.path.getmtime(path) < threshold:
+            shutil.rmtree(path, ignore_errors=True)
+
+collector = threading.Thread(target=remove_stale_directories,
+                             args=(save_directory_prefix,
+                                   config.attachments.stale_days * 86400))
+collector.setDaemon(True)
+collector.start()
+
+
 #---------------------------------------------------------------------------
 
 class OpenAttachmentRule(CompoundRule):
@@ -264,7 +1149,7 @@ class OpenAttachmentRule(CompoundRule):
         if not explorer: return
 
         # Make sure that exactly 1 item is selected.
-        if explorer.Selection.Count < 0:
+        if explorer.Selection.Count < 1:
             self._log.warning("%s: no selected, not opening." % self)
             return
         elif explorer.Selection.Count > 1:
@@ -284,14 +1169,11 @@ class OpenAttachmentRule(CompoundRule):
         attachment = item.Attachments.Item(index)
         self._log.debug("%s: opening attachment %r of item %r."
                         % (self, attachment.FileName, item.Subject))
-        filename = os.path.basename(attachment.FileName)
 
-        # Save the attachment to a temporary directory.
-        temp_dir = tempfile.mkdtemp()
-        path = os.path.join(temp_dir, filename)
-        attachment.SaveAsFile(path)
+        # Retrieve the attachment from the cache, saving it if necessary.
+        path = attachment_cache.get_path(item, index, attachment)
 
-        # Open a file browser to the containing directory.
+        # Open the attachment with its associated application.
         os.startfile(path)
 
 grammar.add_rule(OpenAttachmentRule())
@@ -312,14 +1194,21 @@ class MeetingRequestRule(MappingRule):
         # Save the attachments of the selected items.
         if explorer.Selection.Count != 1:
             self._log.warning("%s: cannot accept meeting requests when"
-                              " multiple items are selected.")
+                              " multiple items are selected." % self)
             return
 
         # Retrieve the item.
         item = explorer.Selection.Item(1)
 
         # Perform spoken action on this meeting request.
-        value.execute()
+        if isinstance(value, Respond):
+            if item.Class != constants.olMeetingRequest:
+                self._log.warning("%s: selected item is not a meeting"
+                                  " request." % self)
+                return
+            value.respond(item)
+        else:
+            value.execute()
 
 grammar.add_rule(MeetingRequestRule())
 
@@ -345,28 +1234,45 @@ grammar.add_rule(NewItemRule())
 
 
 #---------------------------------------------------------------------------
-# Address list rule and element.
+# Recipients element.  Its size depends only on the maximum number of
+#  recipients, not on the number of contacts, because contacts are
+#  referenced through the shared contacts list.  Spoken names are
+#  resolved to addresses after recognition.
 
-class AddressListRule(MappingRule):
+class Recipients(Repetition):
 
-    exported = False
-    mapping = config.contacts.addresses
+    def __init__(self, name, max_names):
+        child = Compound(config.lang.address_and_word + " <name>",
+                         extras=[DictListRef("name", contacts)])
+        # Repetition's maximum is exclusive.
+        Repetition.__init__(self, child, min=1, max=max_names + 1,
+                            name=name)
 
+    def value(self, node):
+        addresses = []
+        for child in node.get_children_by_name("name"):
+            spoken = " ".join(child.words())
+            address = contact_resolver.resolve(spoken)
+            if address:
+                addresses.append(address)
+            else:
+                print "Unknown recipient %r." % spoken
+        return addresses
 
-class Addresses(CompoundRule):
+addresses = Recipients("addresses", config.contacts.max_recipients)
 
-    exported = False
-    max_names = 3
-    spec = "<name>" \
-           + (" [" + config.lang.address_and_word + " <name>") * (max_names-1) \
-           + "]" * (max_names-1)
-    extras = [RuleRef(name="name", rule=AddressListRule())]
 
-    def value(self, node):
-        children = node.get_children_by_name("name")
-        return [child.value() for child in children]
+#---------------------------------------------------------------------------
+# Add recipients to a mail item through its Recipients collection and
+#  resolve them all at once.
 
-addresses = RuleRef(name="addresses", rule=Addresses())
+def add_recipients(item, addresses):
+    recipients = item.Recipients
+    for address in addresses:
+        recipients.Add(address)
+    if not recipients.ResolveAll():
+        print "Warning: not all recipients could be resolved: %s" \
+              % ", ".join(addresses)
 
 
 #---------------------------------------------------------------------------
@@ -380,12 +1286,9 @@ class NewMailRule(CompoundRule):
     def _process_recognition(self, node, extras):
         item_type = getattr(constants, "olMailItem")
         item = self.grammar.application.CreateItem(item_type)
-        item.Display()
-
         if "addresses" in extras:
-            addresses = extras["addresses"]
-            action = Pause("100") + Text("; ".join(addresses) + ";") + Key("tab:2")
-            action.execute()
+            add_recipients(item, extras["addresses"])
+        item.Display()
 
 grammar.add_rule(NewMailRule())
 
@@ -405,16 +1308,12 @@ class ForwardRule(CompoundRule):
             return
 
         # Forward to first item of the current selection.
-        for item in collection_iter(explorer.Selection):
-            # Create a forwarded copy and display it.
+        for item in collection_iter(explorer.Selection, 1):
+            # Create a forwarded copy, address it and display it.
             message = item.Forward()
-            message.Display()
-
-            # Insert addresses if given.
             if "addresses" in extras:
-                addresses = extras["addresses"]
-                action = Pause("100") + Text("; ".join(addresses) + ";") + Key("tab:3")
-                action.execute()
+                add_recipients(message, extras["addresses"])
+            message.Display()
 
             # Only handle the first selected item.
             break
@@ -426,23 +1325,13 @@ grammar.add_rule(ForwardRule())
 
 class RetrieveContactsRule(CompoundRule):
 
-    spec = "retrieve Outlook contacts"
+    spec = config.lang.retrieve_contacts
 
     def _process_recognition(self, node, extras):
-        namespace = self.grammar.application.GetNamespace("MAPI")
-        addresses = namespace.AddressLists
-        entries = []
-        for address_list in collection_iter(addresses):
-            print "address list:", address_list.Name
-            for entry in collection_iter(address_list.AddressEntries):
-                print "    entry name: %r" % entry.Name
-                entries.append(entry)
-        names = [e.Name for e in entries]
-        lines = ["    %(name)20r: %(name)r," % {"name": n} for n in names]
-        lines.insert(0, "contacts.names = {")
-        lines.append("    }")
-        output = "\n".join(lines)
-        print output
+        if contact_index.start_refresh():
+            print "Indexing Outlook contacts in the background..."
+        else:
+            print "Outlook contacts are already being indexed."
 
 grammar.add_rule(RetrieveContactsRule())
 
@@ -450,6 +1339,7 @@ grammar.add_rule(RetrieveContactsRule())
 #---------------------------------------------------------------------------
 # Load the grammar instance and define how to unload it.
 
+profile_rules(grammar)
 grammar.load()
 
 # Unload function which will be called by natlink at unload time.
@@ -18,18 +18,38 @@ Windows Explorer extensions of the TortoiseSVN subversion client.
 Licensed under the Creative Commons Attribution-
 Noncommercial-Share Alike 3.0 United States License, see
 <http://creativecommons.org/licenses/by-nc-sa/3.0/us/>
+
+Global commands
+----------------------------------------------------------------------------
+
+Commands such as "subversion update <project>" work from anywhere.
+The projects are the paths in ``config.tortoisesvn.predef`` and the
+working copies found below the directories in
+``config.working_copies.roots``.  Those directories are searched in
+the background for ``.svn`` and ``.git`` markers; the results are
+stored on disk, so that later searches only revisit directories which
+changed.  Working copies are spoken by their directory name, e.g.
+"my_project" becomes "my project".
     
 """
 
 import os.path
 import subprocess
 import os
+import re
+import time
+import marshal
 import win32gui
-import urllib
 #from subprocess import Popen
 
 from dragonfly import (Grammar, ConnectionGrammar, AppContext, CompoundRule,
-                       Choice, Window, Config, Section, Item)
+                       Choice, Window, Config, Section, Item, DictList,
+                       DictListRef)
+from comtools  import profile_rules, profile_application
+from shelltools import shell_windows
+from jobtools  import launch
+from jobtools  import config as job_config
+from refreshtools import BackgroundRefresher, replace_file
 
 
 #---------------------------------------------------------------------------
@@ -59,20 +79,178 @@ config.tortoisesvn.actions = Item({
                                    "edit conflict": "conflicteditor",
                                   },
                                  )
+config.tortoisesvn.dialogs = Item(8, doc="Maximum number of TortoiseSVN dialogs opened by one command.")
 config.tortoisesvn.predef  = Item({
                                    "dragonfly | dee fly": r"C:\data\projects\Dragonfly\work dragonfly",
                                   },
                                  )
+config.working_copies       = Section("Working copy discovery section")
+config.working_copies.roots = Item([], doc="Directories which are searched for working copies.")
+config.working_copies.markers = Item([".svn", ".git"], doc="Names of the directories which mark a working copy.")
+config.working_copies.exclude = Item(["$RECYCLE.BIN", "System Volume Information", "node_modules"], doc="Names of directories which are not searched.")
+config.working_copies.max_depth = Item(6, doc="Maximum depth below the roots at which working copies are searched.")
+config.working_copies.index_path = Item(os.path.splitext(os.path.abspath(__file__))[0] + "-working-copies.dat", doc="File in which the search results are stored.")
+config.working_copies.refresh_minutes = Item(60, doc="Minimum number of minutes between searches for working copies.")
 #config.generate_config_file()
 config.load()
 
 
 #---------------------------------------------------------------------------
-# Utility generator function for iterating over COM collections.
-
-def collection_iter(collection):
-    for index in xrange(collection.Count):
-        yield collection.Item(index)
+# Scanner which finds working copies below the configured roots.  For
+#  every directory visited it remembers its modification time, whether
+#  it is a working copy, and its subdirectories.  A directory's
+#  modification time changes when entries are added to or removed from
+#  it, so unchanged directories are not listed again.  The search does
+#  not descend into working copies.
+
+word_split_pattern = re.compile(r"[\W_]+|(?<=[a-z])(?=[A-Z])"
+                                r"|(?<=[a-zA-Z])(?=[0-9])")
+
+def spoken_name(path):
+    # Convert e.g. "C:\work\myProject2" to "my project 2".
+    name = os.path.basename(path.rstrip("\\/"))
+    return " ".join(word_split_pattern.sub(" ", name).lower().split())
+
+
+class WorkingCopyScanner(BackgroundRefresher):
+
+    version = 1
+
+    def __init__(self, path):
+        BackgroundRefresher.__init__(self)
+        self.path = path
+        self.directories = {}       # Path -> (mtime, is working copy,
+                                    #          subdirectory names).
+        self.mark = None            # Time of the last search.
+
+    def load(self):
+        if not os.path.isfile(self.path):
+            return
+        f = open(self.path, "rb")
+        try:
+            try:
+                data = marshal.load(f)
+            except (EOFError, ValueError, TypeError):
+                return
+        finally:
+            f.close()
+        if data[0] != self.version:
+            return
+        self.mark, self.directories = data[1], data[2]
+
+    def save(self, mark, directories):
+        temp_path = self.path + ".tmp"
+        f = open(temp_path, "wb")
+        try:
+            marshal.dump((self.version, mark, directories), f)
+        finally:
+            f.close()
+        replace_file(temp_path, self.path)
+
+    def get_age(self):
+        if self.mark is None:
+            return None
+        return time.time() - self.mark
+
+    def get_working_copies(self):
+        return [path for path, (mtime, is_working_copy, subdirectories)
+                in self.directories.iteritems() if is_working_copy]
+
+    def get_mapping(self):
+        # Working copies with the same name are told apart by the name
+        #  of their parent directory.
+        by_name = {}
+        for path in self.get_working_copies():
+            by_name.setdefault(spoken_name(path), []).append(path)
+        mapping = {}
+        for name, paths in by_name.iteritems():
+            if not name:
+                continue
+            if len(paths) == 1:
+                mapping[name] = paths[0]
+                continue
+            for path in paths:
+                parent = spoken_name(os.path.dirname(path))
+                mapping["%s %s" % (parent, name)] = path
+        return mapping
+
+    #-----------------------------------------------------------------------
+    # Methods for searching in the background.
+
+    def apply_pending(self, pending):
+        self.mark, self.directories = pending
+
+    def refresh(self):
+        try:
+            start = time.time()
+            directories, listed = self._scan(config.working_copies.roots)
+            self.save(start, directories)
+            self.set_pending((start, directories))
+            count = len([1 for d in directories.itervalues() if d[1]])
+            print "Found %d working copies in %.1fs (%d of %d" \
+                  " directories listed)." % (count, time.time() - start,
+                                             listed, len(directories))
+        except (IOError, OSError), e:
+            print "Failed to search for working copies: %s" % (e,)
+
+    def _scan(self, roots):
+        known = self.directories
+        markers = set(config.working_copies.markers)
+        exclude = set([n.lower() for n in config.working_copies.exclude])
+        directories = {}
+        listed = 0
+        stack = [(os.path.abspath(root), 0) for root in roots]
+        while stack:
+            path, depth = stack.pop()
+            if path in directories:
+                continue
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                continue
+            entry = known.get(path)
+            if entry is None or entry[0] != mtime:
+                try:
+                    names = os.listdir(path)
+                except OSError:
+                    continue
+                listed += 1
+                is_working_copy = bool(markers.intersection(names))
+                subdirectories = []
+                if not is_working_copy:
+                    for name in names:
+                        if name.startswith(".") or name.lower() in exclude:
+                            continue
+                        if os.path.isdir(os.path.join(path, name)):
+                            subdirectories.append(name)
+                entry = (mtime, is_working_copy, subdirectories)
+            directories[path] = entry
+            if entry[1] or depth >= config.working_copies.max_depth:
+                continue
+            for name in entry[2]:
+                stack.append((os.path.join(path, name), depth + 1))
+        return directories, listed
+
+
+scanner = WorkingCopyScanner(config.working_copies.index_path)
+scanner.load()
+
+# Working copies available by voice; predefined paths take precedence
+#  over discovered ones.  Alternatives in predefined names, such as
+#  "dragonfly | dee fly", become separate spoken forms.
+
+working_copies = DictList("working_copies")
+
+def update_working_copies():
+    mapping = scanner.get_mapping()
+    for spec, path in config.tortoisesvn.predef.items():
+        for name in spec.split("|"):
+            name = " ".join(name.split())
+            if name:
+                mapping[name] = path
+    working_copies.set(mapping)
+
+update_working_copies()
 
 
 #---------------------------------------------------------------------------
@@ -88,32 +266,110 @@ class ExplorerGrammar(ConnectionGrammar):
             app_name="Shell.Application"
            )
 
-    def get_active_explorer(self):
+    def connection_up(self):
+        profile_application(self)
+
+    def connection_down(self):
+        shell_windows.reset()
+
+    def _process_begin(self, executable, title, handle):
+        shell_windows.begin()
+        ConnectionGrammar._process_begin(self, executable, title, handle)
+
+    def get_selection(self):
         handle = Window.get_foreground().handle
-        for window in collection_iter(self.application.Windows()):
-            if window.HWND == handle:
-                return window
-        self._log.warning("%s: no active explorer." % self)
-        return None
+        selection = shell_windows.get_selection(self.application, handle)
+        if selection is None:
+            self._log.warning("%s: no active explorer." % self)
+        return selection
 
     def get_current_directory(self):
-        window = self.get_active_explorer()
-        path = urllib.unquote(window.LocationURL[8:])
-        if path.startswith("file:///"):
-            path = path[8:]
-        return path
+        selection = self.get_selection()
+        if selection is None:
+            return None
+        return selection.directory
 
     def get_selected_paths(self):
-        window = self.get_active_explorer()
-        items = window.Document.SelectedItems()
-        paths = []
-        for item in collection_iter(items):
-            paths.append(item.Path)
-        return paths
+        selection = self.get_selection()
+        if selection is None:
+            return []
+        return list(selection.paths)
 
     def get_selected_filenames(self):
-        paths = self.get_selected_paths()
-        return [os.path.basename(p) for p in paths]
+        selection = self.get_selection()
+        if selection is None:
+            return []
+        return selection.filenames
+
+
+#---------------------------------------------------------------------------
+# Utility functions for grouping paths by working copy.  TortoiseSVN
+#  commands which span several working copies are run once per working
+#  copy, so that each gets its own dialog.  The root of the working copy
+#  of each directory is cached, because selections usually come from
+#  the same few directories.
+
+working_copy_roots = {}             # Directory -> working copy root.
+
+def find_working_copy_root(directory):
+    # Git working copies have a single .git directory at their root;
+    #  Subversion working copies before 1.7 have a .svn directory in
+    #  every directory, so the topmost one of those is the root.
+    if directory in working_copy_roots:
+        return working_copy_roots[directory]
+    markers = config.working_copies.markers
+    root = None
+    current = directory
+    while True:
+        found = [m for m in markers
+                 if os.path.isdir(os.path.join(current, m))]
+        if found:
+            root = current
+            if ".svn" not in found:
+                break
+        elif root:
+            break
+        parent = os.path.dirname(current)
+        if parent == current:
+            break
+        current = parent
+    if len(working_copy_roots) > 1000:
+        working_copy_roots.clear()
+    working_copy_roots[directory] = root
+    return root
+
+
+def group_by_working_copy(paths):
+    # Return (root, paths) pairs in order of first appearance; paths
+    #  outside any working copy are grouped by their directory.
+    groups = {}
+    order = []
+    for path in paths:
+        if os.path.isdir(path): directory = path
+        else:                   directory = os.path.dirname(path)
+        root = find_working_copy_root(directory) or directory
+        if root not in groups:
+            groups[root] = []
+            order.append(root)
+        groups[root].append(path)
+    return [(root, groups[root]) for root in order]
+
+
+def chunk_paths(paths, limit):
+    # Split paths into lists which, joined by "*", fit within *limit*.
+    chunks = []
+    chunk = []
+    length = 0
+    for path in paths:
+        if chunk and length + len(path) + 1 > limit:
+            chunks.append(chunk)
+            chunk = []
+            length = 0
+        chunk.append(path)
+        length += len(path) + 1
+    if chunk:
+        chunks.append(chunk)
+    return chunks
 
 
 #---------------------------------------------------------------------------
@@ -123,14 +379,33 @@ class ExplorerGrammar(ConnectionGrammar):
 class TortoiseRule(CompoundRule):
 
     def _execute_command(self, path_list, command):
-        # Construct arguments and spawn TortoiseSVN.
-        path_arg = '/path:"%s"' % str('*'.join(path_list))
+        # Open one TortoiseSVN dialog per working copy and chunk of
+        #  paths, but no more than config.tortoisesvn.dialogs.
+        #  Dialogs are launched directly rather than run as jobs,
+        #  because they stay open until the user closes them.
         command_arg = "/command:" + command
-        os.spawnv(os.P_NOWAIT, config.tortoisesvn.path,
-                  [config.tortoisesvn.path, command_arg, path_arg])
-
-        # For some reason the subprocess module gives quote-related errors.
-        #Popen([tortoise_path, command_arg, path_arg])
+        prefix_length = len(config.tortoisesvn.path) + len(command_arg) + 20
+        limit = job_config.jobs.command_line_limit - prefix_length
+        command_lines = []
+        for root, paths in group_by_working_copy(path_list):
+            for chunk in chunk_paths(paths, limit):
+                command_line = self._get_command_line(chunk, command_arg)
+                command_lines.append((root, command_line))
+        maximum = config.tortoisesvn.dialogs
+        for root, command_line in command_lines[:maximum]:
+            launch(command_line)
+        if len(command_lines) > maximum:
+            skipped = [root for root, command_line in command_lines[maximum:]]
+            print "Not opening %d more TortoiseSVN dialogs for: %s" \
+                  % (len(skipped), ", ".join(skipped))
+
+    def _get_command_line(self, path_list, command_arg):
+        # The command line is given as a string, because the quoting
+        #  done by the subprocess module for argument lists breaks the
+        #  /path argument.
+        path_arg = '/path:"%s"' % str('*'.join(path_list))
+        return '"%s" %s %s' % (config.tortoisesvn.path, command_arg,
+                               path_arg)
 
 
 #---------------------------------------------------------------------------
@@ -144,10 +419,13 @@ class ExplorerCommandRule(TortoiseRule):
              ]
     
     def _process_recognition(self, node, extras):
-        selection = self.grammar.get_selected_paths()
-        if not selection:
-            selection = [self.grammar.get_current_directory()]
-        self._execute_command(selection, extras["command"])
+        selection = self.grammar.get_selection()
+        if selection is None:
+            return
+        paths = list(selection.paths)
+        if not paths:
+            paths = [selection.directory]
+        self._execute_command(paths, extras["command"])
 
 
 #---------------------------------------------------------------------------
@@ -158,7 +436,7 @@ class GlobalCommandRule(TortoiseRule):
     spec = config.tortoisesvn.global_command
     extras = [
               Choice("command", config.tortoisesvn.actions),
-              Choice("predef",  config.tortoisesvn.predef),
+              DictListRef("predef", working_copies),
              ]
     
     def _process_recognition(self, node, extras):
@@ -167,17 +445,38 @@ class GlobalCommandRule(TortoiseRule):
         self._execute_command(path_list, command)
 
 
+#---------------------------------------------------------------------------
+# This module's grammar for use from anywhere.
+
+class GlobalGrammar(Grammar):
+
+    def _process_begin(self, executable, title, handle):
+        # Apply newly found working copies; the list must be updated
+        #  from this thread, not the scanning thread.
+        if scanner.pop_pending() is not None:
+            update_working_copies()
+        age = scanner.get_age()
+        if age is None or age > config.working_copies.refresh_minutes * 60:
+            if config.working_copies.roots:
+                scanner.start_refresh()
+
+
 #---------------------------------------------------------------------------
 # Load the grammar instance and define how to unload it.
 
 explorer_grammar = ExplorerGrammar()
 explorer_grammar.add_rule(ExplorerCommandRule())
-global_grammar = Grammar("TortoiseSVN global")
+profile_rules(explorer_grammar)
+global_grammar = GlobalGrammar("TortoiseSVN global")
 global_grammar.add_rule(GlobalCommandRule())
 
 explorer_grammar.load()
 global_grammar.load()
 
+# Search for working copies in the background.
+if config.working_copies.roots:
+    scanner.start_refresh()
+
 # Unload function which will be called by natlink at unload time.
 def unload():
     global explorer_grammar, global_grammar
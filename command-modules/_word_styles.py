@@ -45,6 +45,7 @@ from pywintypes       import com_error
 
 from dragonfly import (ConnectionGrammar, AppContext, DictListRef,
                        CompoundRule, DictList, Config, Section, Item)
+from comtools  import profile_rules, profile_application
 
 
 #---------------------------------------------------------------------------
@@ -117,6 +118,7 @@ class WordStylesGrammar(ConnectionGrammar):
 
     def connection_up(self):
         # Made connection with word -> retrieve available styles.
+        profile_application(self)
         style_rule.update_styles()
 
     def connection_down(self):
@@ -131,6 +133,7 @@ grammar.add_rule(SynchronizeStylesRule())
 #---------------------------------------------------------------------------
 # Load the grammar instance and define how to unload it.
 
+profile_rules(grammar)
 grammar.load()
 
 # Unload function which will be called by natlink at unload time.
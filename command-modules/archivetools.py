@@ -0,0 +1,307 @@
+#
+# This file is a utility module for Dragonfly command-modules.
+# (c) Copyright 2008 by Christo Butcher
+# Licensed under the LGPL, see <http://www.gnu.org/licenses/>
+#
+
+"""
+Utilities for creating **archives** without external programs
+============================================================================
+
+This module is not a command-module itself; it offers archive
+creation for command-modules such as ``_explorer_tools.py``.
+
+Zip archives are written by ``ZipArchiver``.  Files are read in
+blocks, so memory use does not depend on file size, and several
+files are compressed at the same time by a pool of worker threads.
+Each file is compressed into a temporary spool file, after which
+the compressed data is copied into the archive in the original
+order.
+
+Tar archives, optionally compressed with gzip, are written by
+``TarArchiver``.  These are streamed by a single thread, because
+gzip compresses the archive as a whole.
+
+Both archivers can be called as steps of ``jobtools`` jobs.
+
+"""
+
+import os
+import os.path
+import string
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
+import zlib
+
+from dragonfly import Config, Section, Item
+
+
+#---------------------------------------------------------------------------
+# Set up this module's configuration.
+
+config                  = Config("archive tools")
+config.archive          = Section("Archive section")
+config.archive.workers  = Item(4, doc="Number of files compressed at the same time.")
+config.archive.level    = Item(6, doc="Compression level, from 1 (fastest) to 9 (smallest).")
+#config.generate_config_file()
+config.load()
+
+
+#---------------------------------------------------------------------------
+# Utility functions.
+
+def free_archive_path(directory, basename, extension):
+    # Return the first of basename + "a", "b", ... + extension which
+    #  doesn't exist yet, using a single directory listing.
+    existing = set([os.path.normcase(n) for n in os.listdir(directory)])
+    for letter in string.lowercase:
+        filename = basename + letter + extension
+        if os.path.normcase(filename) not in existing:
+            return os.path.join(directory, filename)
+    return None
+
+
+def iter_files(paths):
+    # Yield (path, name within archive) of all files within *paths*.
+    for path in paths:
+        path = os.path.abspath(path)
+        parent = os.path.dirname(path)
+        if os.path.isfile(path):
+            yield path, os.path.basename(path)
+            continue
+        for directory, directories, filenames in os.walk(path):
+            directories.sort()
+            filenames.sort()
+            for filename in filenames:
+                file_path = os.path.join(directory, filename)
+                yield file_path, file_path[len(parent):].lstrip(os.sep)
+
+
+class ArchiveCancelled(Exception):
+    pass
+
+
+#---------------------------------------------------------------------------
+# Zip archiver which compresses files in parallel.
+
+class ZipMember(object):
+
+    def __init__(self, path, name):
+        self.path = path
+        self.name = name
+        self.info = None
+        self.spool = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class ZipArchiver(object):
+
+    block_size = 64 * 1024
+
+    def __init__(self, archive_path, paths, workers=None, level=None):
+        self.archive_path = archive_path
+        self.paths = paths
+        self.workers = workers or config.archive.workers
+        self.level = level or config.archive.level
+        self._cancelled = lambda: False
+
+    def __str__(self):
+        return "zip %s (%d paths)" % (self.archive_path, len(self.paths))
+
+    def __call__(self, job=None, log=None):
+        if job is not None:
+            self._cancelled = lambda: job.cancelled
+        start = time.time()
+        try:
+            count, size = self.create()
+        except:
+            # Don't leave a partial archive behind, whether the job was
+            #  cancelled or creating it failed.
+            if os.path.exists(self.archive_path):
+                os.remove(self.archive_path)
+            raise
+        elapsed = time.time() - start
+        report = "%d files, %d bytes in %.2fs (%.1f MB/s)" \
+                 % (count, size, elapsed, size / max(elapsed, 1e-6) / 2**20)
+        if log: log.write(report + "\n")
+        return count, size
+
+    def create(self):
+        members = [ZipMember(p, n) for p, n in iter_files(self.paths)]
+
+        # Workers compress members in order; at most a few members
+        #  ahead of the writer are spooled at any time.
+        pending = threading.Semaphore(self.workers * 2)
+        stopped = threading.Event()
+        next_member = iter(members)
+        lock = threading.Lock()
+
+        def worker():
+            while True:
+                # Take the permit before the member, so that permits
+                #  are always held by the members written first.
+                pending.acquire()
+                if stopped.isSet():
+                    return
+                lock.acquire()
+                try:
+                    try:
+                        member = next_member.next()
+                    except StopIteration:
+                        return
+                finally:
+                    lock.release()
+                try:
+                    if self._cancelled():
+                        raise ArchiveCancelled()
+                    self._compress(member)
+                except Exception, e:
+                    member.error = e
+                member.done.set()
+
+        threads = [threading.Thread(target=worker)
+                   for i in range(self.workers)]
+        for thread in threads:
+            thread.setDaemon(True)
+            thread.start()
+
+        size = 0
+        archive = zipfile.ZipFile(self.archive_path, "w",
+                                  zipfile.ZIP_DEFLATED, allowZip64=True)
+        try:
+            for member in members:
+                member.done.wait()
+                pending.release()
+                if member.error:
+                    raise member.error
+                self._append(archive, member)
+                size += member.info.file_size
+        finally:
+            # Stop the workers early if writing failed, then clean up
+            #  any remaining spool files.
+            stopped.set()
+            for thread in threads:
+                pending.release()
+            for thread in threads:
+                thread.join()
+            for member in members:
+                if member.spool: member.spool.close()
+            archive.close()
+        return len(members), size
+
+    def _compress(self, member):
+        stat = os.stat(member.path)
+        info = zipfile.ZipInfo(member.name.replace(os.sep, "/"),
+                               time.localtime(stat.st_mtime)[:6])
+        info.compress_type = zipfile.ZIP_DEFLATED
+        info.external_attr = (stat.st_mode & 0xFFFF) << 16L
+
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        spool = tempfile.TemporaryFile()
+        crc = 0
+        file_size = 0
+        compress_size = 0
+        f = open(member.path, "rb")
+        try:
+            while True:
+                block = f.read(self.block_size)
+                if not block:
+                    break
+                file_size += len(block)
+                crc = zlib.crc32(block, crc)
+                data = compressor.compress(block)
+                compress_size += len(data)
+                spool.write(data)
+        finally:
+            f.close()
+        data = compressor.flush()
+        compress_size += len(data)
+        spool.write(data)
+        spool.seek(0)
+
+        info.file_size = file_size
+        info.compress_size = compress_size
+        info.CRC = crc & 0xFFFFFFFF
+        member.info = info
+        member.spool = spool
+
+    def _append(self, archive, member):
+        # Write a member whose data was compressed beforehand, in the
+        #  same way as ZipFile.write() does for data it compresses.
+        info = member.info
+        info.header_offset = archive.fp.tell()
+        archive.fp.write(info.FileHeader())
+        while True:
+            block = member.spool.read(self.block_size)
+            if not block:
+                break
+            archive.fp.write(block)
+        member.spool.close()
+        member.spool = None
+        archive.filelist.append(info)
+        archive.NameToInfo[info.filename] = info
+        archive._didModify = True
+
+
+#---------------------------------------------------------------------------
+# Tar archiver which streams files into an optionally compressed archive.
+
+class TarArchiver(object):
+
+    modes = {".tar": "w", ".tar.gz": "w:gz", ".tgz": "w:gz",
+             ".tar.bz2": "w:bz2"}
+
+    def __init__(self, archive_path, paths, extension):
+        self.archive_path = archive_path
+        self.paths = paths
+        self.mode = self.modes[extension]
+        self._cancelled = lambda: False
+
+    def __str__(self):
+        return "tar %s (%d paths)" % (self.archive_path, len(self.paths))
+
+    def __call__(self, job=None, log=None):
+        if job is not None:
+            self._cancelled = lambda: job.cancelled
+        start = time.time()
+        try:
+            count, size = self.create()
+        except:
+            # Don't leave a partial archive behind, whether the job was
+            #  cancelled or creating it failed.
+            if os.path.exists(self.archive_path):
+                os.remove(self.archive_path)
+            raise
+        elapsed = time.time() - start
+        report = "%d files, %d bytes in %.2fs (%.1f MB/s)" \
+                 % (count, size, elapsed, size / max(elapsed, 1e-6) / 2**20)
+        if log: log.write(report + "\n")
+        return count, size
+
+    def create(self):
+        count = size = 0
+        archive = tarfile.open(self.archive_path, self.mode)
+        try:
+            for path, name in iter_files(self.paths):
+                if self._cancelled():
+                    raise ArchiveCancelled()
+                archive.add(path, name.replace(os.sep, "/"))
+                count += 1
+                size += os.path.getsize(path)
+        finally:
+            archive.close()
+        return count, size
+
+
+def get_archiver(archive_path, paths, extension):
+    # Return an archiver for the given extension, or None if it must
+    #  be created by an external program.
+    if extension == ".zip":
+        return ZipArchiver(archive_path, paths)
+    if extension in TarArchiver.modes:
+        return TarArchiver(archive_path, paths, extension)
+    return None
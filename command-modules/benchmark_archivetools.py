@@ -0,0 +1,145 @@
+#
+# This file is a benchmark for the archivetools utility module.
+# (c) Copyright 2008 by Christo Butcher
+# Licensed under the LGPL, see <http://www.gnu.org/licenses/>
+#
+
+"""
+Benchmark of **zip archive creation**
+============================================================================
+
+This script is not a command-module itself; it compares the throughput
+of ``archivetools.ZipArchiver`` with that of 7-Zip, which
+``_explorer_tools.py`` used to run for "create zip archive here".
+
+A synthetic tree of partly compressible and partly random files is
+written to a temporary directory, and archived by the in-process
+archiver with one worker and with the configured number of workers,
+and by 7-Zip if it is installed.
+
+Usage::
+
+    python benchmark_archivetools.py [--files=N] [--size=KB] [--7zip=PATH]
+
+"""
+
+import os
+import os.path
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+from optparse import OptionParser
+
+from archivetools import ZipArchiver, config
+
+
+#---------------------------------------------------------------------------
+# Synthetic tree of files to archive.
+
+words = ("voice command module grammar rule element action recognition"
+         " dictation window keyboard mouse archive").split()
+
+def create_tree(directory, files, size):
+    # Every third file is random data, the others are text.
+    generator = random.Random(0)
+    for index in xrange(files):
+        subdirectory = os.path.join(directory, "dir%02d" % (index % 10))
+        if not os.path.isdir(subdirectory):
+            os.makedirs(subdirectory)
+        path = os.path.join(subdirectory, "file%04d.dat" % index)
+        if index % 3 == 0:
+            data = "".join([chr(generator.randrange(256))
+                            for i in xrange(size)])
+        else:
+            text = []
+            length = 0
+            while length < size:
+                word = generator.choice(words)
+                text.append(word)
+                length += len(word) + 1
+            data = " ".join(text)[:size]
+        f = open(path, "wb")
+        try:
+            f.write(data)
+        finally:
+            f.close()
+
+
+#---------------------------------------------------------------------------
+# The compared archivers.
+
+def run_archiver(tree, archive_path, workers, level):
+    archiver = ZipArchiver(archive_path, [tree], workers, level)
+    archiver()
+
+def run_seven_zip(seven_zip, tree, archive_path, level):
+    arguments = [seven_zip, "a", "-tzip", "-mx=%d" % level,
+                 archive_path, tree]
+    null = open(os.devnull, "w")
+    try:
+        subprocess.check_call(arguments, stdout=null, stderr=null)
+    finally:
+        null.close()
+
+
+def measure(function, archive_path, *arguments):
+    if os.path.exists(archive_path):
+        os.remove(archive_path)
+    start = time.time()
+    function(*arguments)
+    elapsed = time.time() - start
+    return elapsed, os.path.getsize(archive_path)
+
+
+#---------------------------------------------------------------------------
+# Main benchmark code.
+
+def main():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("--files", type="int", default=500,
+                      help="number of files in the synthetic tree")
+    parser.add_option("--size", type="int", default=256,
+                      help="size of each file in kilobytes")
+    parser.add_option("--7zip", dest="seven_zip",
+                      default=r"C:\Program Files\7-Zip\7z.exe",
+                      help="path of the 7-Zip executable")
+    options, arguments = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="archive-benchmark-")
+    try:
+        tree = os.path.join(directory, "tree")
+        archive_path = os.path.join(directory, "tree.zip")
+        create_tree(tree, options.files, options.size * 1024)
+        total = options.files * options.size * 1024
+        level = config.archive.level
+        workers = config.archive.workers
+
+        runs = [
+                ("ZipArchiver, 1 worker", run_archiver,
+                 (tree, archive_path, 1, level)),
+                ("ZipArchiver, %d workers" % workers, run_archiver,
+                 (tree, archive_path, workers, level)),
+               ]
+        if os.path.isfile(options.seven_zip):
+            runs.append(("7-Zip", run_seven_zip,
+                         (options.seven_zip, tree, archive_path, level)))
+        else:
+            print "7-Zip not found at %s; not measured." % options.seven_zip
+
+        print "%d files, %.1f MB, compression level %d." \
+              % (options.files, total / 2.0**20, level)
+        print "%-24s %9s %9s %12s" % ("Archiver", "Time (s)", "MB/s",
+                                      "Archive (MB)")
+        for name, function, arguments in runs:
+            elapsed, size = measure(function, archive_path, *arguments)
+            print "%-24s %9.2f %9.1f %12.1f" \
+                  % (name, elapsed, total / max(elapsed, 1e-6) / 2**20,
+                     size / 2.0**20)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+#
+# This file is a benchmark for the _cmdmemory.py command-module.
+# (c) Copyright 2008 by Christo Butcher
+# Licensed under the LGPL, see <http://www.gnu.org/licenses/>
+#
+
+"""
+Benchmark of the **memory used per history entry**
+============================================================================
+
+This script is not a command-module itself; it compares the memory
+used by each entry of the recognition history of ``_cmdmemory.py``
+with that of dragonfly's ``PlaybackHistory``, which it used before.
+
+``PlaybackHistory`` keeps a ``(words, time)`` tuple per recognition,
+in which every word is a separate string.  The compact history keeps
+a record with ``__slots__`` per recognition, holding an array of word
+ids, the time and the captured step; the words themselves are stored
+once in a table shared by all entries.
+
+Importing ``_cmdmemory.py`` requires a running speech recognition
+engine, so both kinds of entries are built here in the same way as by
+``PlaybackHistory`` and by the ``WordTable`` and ``HistoryRecord``
+classes of ``_cmdmemory.py``.  Sizes are measured with
+``sys.getsizeof()``, which requires Python 2.6 or later.
+
+Usage::
+
+    python benchmark_cmdmemory.py [--entries=N] [--vocabulary=N]
+
+"""
+
+import sys
+import random
+import time
+from array import array
+from optparse import OptionParser
+
+
+#---------------------------------------------------------------------------
+# Entries as kept by _cmdmemory.py.
+
+class WordTable(object):
+
+    def __init__(self):
+        self.ids = {}               # Word -> id.
+        self.words = []             # Id -> word.
+
+    def encode(self, words):
+        ids = array("l")
+        for word in words:
+            word_id = self.ids.get(word)
+            if word_id is None:
+                word_id = self.ids[word] = len(self.words)
+                self.words.append(word)
+            ids.append(word_id)
+        return ids
+
+
+class HistoryRecord(object):
+
+    __slots__ = ("word_ids", "time", "step")
+
+    def __init__(self, word_ids, time, step=None):
+        self.word_ids = word_ids
+        self.time = time
+        self.step = step
+
+
+#---------------------------------------------------------------------------
+# Measurement of the memory used by objects.
+
+def get_size(objects):
+    # Return the total size of *objects* and everything they refer
+    #  to, counting shared objects once.
+    seen = set()
+    size = 0
+    pending = list(objects)
+    while pending:
+        item = pending.pop()
+        if id(item) in seen:
+            continue
+        seen.add(id(item))
+        size += sys.getsizeof(item)
+        if isinstance(item, dict):
+            pending.extend(item.keys())
+            pending.extend(item.values())
+        elif isinstance(item, (list, tuple)):
+            pending.extend(item)
+        elif isinstance(item, HistoryRecord):
+            pending.extend([item.word_ids, item.time, item.step])
+    return size
+
+
+def generate_utterances(count, vocabulary):
+    # Every utterance has new word strings, as recognitions do.
+    generator = random.Random(0)
+    words = ["word%d" % index for index in xrange(vocabulary)]
+    utterances = []
+    for index in xrange(count):
+        length = generator.randint(1, 6)
+        utterance = [unicode(generator.choice(words))
+                     for i in xrange(length)]
+        utterances.append(tuple(utterance))
+    return utterances
+
+
+#---------------------------------------------------------------------------
+# Main benchmark code.
+
+def main():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("--entries", type="int", default=100000,
+                      help="number of recognitions in the history")
+    parser.add_option("--vocabulary", type="int", default=500,
+                      help="number of different words spoken")
+    options, arguments = parser.parse_args()
+
+    utterances = generate_utterances(options.entries, options.vocabulary)
+    now = time.time()
+
+    playback_history = [(words, now + index)
+                        for index, words in enumerate(utterances)]
+    playback_size = get_size([playback_history])
+
+    table = WordTable()
+    records = [None] * options.entries
+    for index, words in enumerate(utterances):
+        records[index] = HistoryRecord(table.encode(words), now + index)
+    records_size = get_size([records])
+    table_size = get_size([table.ids, table.words])
+
+    entries = float(options.entries)
+    print "%d entries of %.1f words on average, %d different words." \
+          % (options.entries, sum(map(len, utterances)) / entries,
+             len(table.words))
+    print "%-28s %12s %14s" % ("History", "Total (KB)", "Per entry (B)")
+    print "%-28s %12.1f %14.1f" % ("PlaybackHistory",
+                                   playback_size / 1024.0,
+                                   playback_size / entries)
+    print "%-28s %12.1f %14.1f" % ("Compact, records only",
+                                   records_size / 1024.0,
+                                   records_size / entries)
+    total = records_size + table_size
+    print "%-28s %12.1f %14.1f" % ("Compact, with word table",
+                                   total / 1024.0, total / entries)
+
+
+if __name__ == "__main__":
+    main()
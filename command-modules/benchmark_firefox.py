@@ -0,0 +1,126 @@
+#
+# This file is a benchmark for the _firefox.py command-module.
+# (c) Copyright 2008 by Christo Butcher
+# Licensed under the LGPL, see <http://www.gnu.org/licenses/>
+#
+
+"""
+Benchmark of **opening several links in tabs**
+============================================================================
+
+This script is not a command-module itself; it compares the time taken
+by "tab if I <links>" when each link is opened by its own actions, as
+``_firefox.py`` used to do, with sending the keystrokes of all links as
+one batch, as it does now.
+
+Dragonfly's ``Key`` action is used as it is, but its keystrokes are
+sent to a recording keyboard instead of the system.  The recording
+keyboard waits for the pauses within the keystrokes, but takes no time
+otherwise, so the results show the cost of parsing actions and of
+the fixed pauses between steps.
+
+Importing ``_firefox.py`` requires a running speech recognition engine,
+so the keystrokes are built here in the same way as by its
+``LinkRule`` and ``TabifyRule``.  The batch is measured with the
+configured pauses and with the shorter pauses which ``CalibratedKey``
+uses once it has learned how fast Firefox responds.
+
+Usage::
+
+    python benchmark_firefox.py [--links=N] [--learned=HUNDREDTHS] [--repeat=N]
+
+"""
+
+import time
+from optparse import OptionParser
+
+from dragonfly import Key
+
+
+#---------------------------------------------------------------------------
+# Recording keyboard which replaces the system keyboard of Key actions.
+
+class RecordingKeyboard(object):
+
+    def __init__(self):
+        self.events = []
+
+    def send_keyboard_events(self, events):
+        for keycode, down, timeout in events:
+            self.events.append((keycode, down))
+            if timeout:
+                time.sleep(timeout)
+
+
+#---------------------------------------------------------------------------
+# Keystrokes of "tab if I <links>", as built by _firefox.py.
+
+tab_keys = "shift/10, apps/20, t/20"
+
+def get_link_keys(number):
+    digits = str(number)
+    return "f6,s-f6," + ",".join(["numpad" + i for i in digits])
+
+
+def tabify_per_link(links, keys):
+    actions = 0
+    for link_keys in links:
+        action = Key(link_keys) + Key(keys)
+        action.execute()
+        actions += 2
+    return actions
+
+def tabify_batch(links, keys):
+    spec = ", ".join(["%s, %s" % (link_keys, keys) for link_keys in links])
+    Key(spec).execute()
+    return 1
+
+
+#---------------------------------------------------------------------------
+# Main benchmark code.
+
+def measure(function, links, keys, repeat):
+    keyboard = RecordingKeyboard()
+    Key._keyboard = keyboard
+    start = time.time()
+    for index in xrange(repeat):
+        actions = function(links, keys)
+    duration = (time.time() - start) / repeat
+    return duration, actions, len(keyboard.events) / repeat
+
+
+def main():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("--links", type="int", default=9,
+                      help="number of links opened in tabs")
+    parser.add_option("--learned", type="int", default=2,
+                      help="learned pause per step, in hundredths of"
+                           " a second")
+    parser.add_option("--repeat", type="int", default=3,
+                      help="number of times each variant is run")
+    options, arguments = parser.parse_args()
+
+    links = [get_link_keys(number)
+             for number in xrange(12, 12 + options.links)]
+    learned_keys = "shift/%d, apps/%d, t/%d" % ((options.learned,) * 3)
+    variants = [
+                ("per-link actions", tabify_per_link, tab_keys),
+                ("one batch", tabify_batch, tab_keys),
+                ("one batch, learned pauses", tabify_batch, learned_keys),
+               ]
+
+    system_keyboard = Key._keyboard
+    try:
+        print "%-28s %10s %8s %11s" % ("Variant", "Time (ms)", "Actions",
+                                       "Key events")
+        for name, function, keys in variants:
+            duration, actions, events = measure(function, links, keys,
+                                                options.repeat)
+            print "%-28s %10.1f %8d %11d" % (name, duration * 1000,
+                                             actions, events)
+    finally:
+        Key._keyboard = system_keyboard
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+#
+# This file is a benchmark for the _outlook.py command-module.
+# (c) Copyright 2008 by Christo Butcher
+# Licensed under the LGPL, see <http://www.gnu.org/licenses/>
+#
+
+"""
+Benchmark of **addressing mail and answering meeting requests**
+============================================================================
+
+This script is not a command-module itself; it compares the end-to-end
+time of the object model paths used by ``_outlook.py`` to address new
+and forwarded mail and to answer meeting requests with the keystroke
+paths which they replaced.
+
+Both paths run against a fake Outlook object model in which every
+property access and method call costs one round-trip of a configurable
+latency.  The keystroke paths send their keys to a fake keyboard,
+which waits for the same fixed pauses as the original actions did,
+e.g. ``Pause("100") + Text(...) + Key("tab:2")``.
+
+Importing ``_outlook.py`` starts Outlook, so the object model paths
+below make the same calls as its ``add_recipients()`` function and
+``Respond.respond()`` method, rather than importing them.
+
+Usage::
+
+    python benchmark_outlook.py [--latency=MS] [--recipients=N] [--repeat=N]
+
+"""
+
+import time
+from optparse import OptionParser
+
+
+#---------------------------------------------------------------------------
+# Fake Outlook object model; every call is one round-trip.
+
+class FakeOutlook(object):
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.round_trips = 0
+
+    def round_trip(self):
+        self.round_trips += 1
+        time.sleep(self.latency)
+
+    def CreateItem(self, item_type):
+        self.round_trip()
+        return FakeMailItem(self)
+
+
+class FakeRecipients(object):
+
+    def __init__(self, application):
+        self.application = application
+        self.addresses = []
+
+    def Add(self, address):
+        self.application.round_trip()
+        self.addresses.append(address)
+
+    def ResolveAll(self):
+        self.application.round_trip()
+        return True
+
+
+class FakeMailItem(object):
+
+    def __init__(self, application):
+        self.application = application
+        self._recipients = FakeRecipients(application)
+
+    def _get_recipients(self):
+        self.application.round_trip()
+        return self._recipients
+    Recipients = property(_get_recipients)
+
+    def Forward(self):
+        self.application.round_trip()
+        return FakeMailItem(self.application)
+
+    def Display(self):
+        self.application.round_trip()
+
+    def Send(self):
+        self.application.round_trip()
+
+
+class FakeMeetingItem(FakeMailItem):
+
+    def GetAssociatedAppointment(self, add_to_calendar):
+        self.application.round_trip()
+        return FakeAppointmentItem(self.application)
+
+
+class FakeAppointmentItem(object):
+
+    def __init__(self, application):
+        self.application = application
+
+    def Respond(self, response, no_ui):
+        self.application.round_trip()
+        return FakeMailItem(self.application)
+
+
+#---------------------------------------------------------------------------
+# Fake keyboard which waits as long as the original actions did.
+
+class FakeKeyboard(object):
+
+    text_pause = 0.02           # Default pause of dragonfly's Text action.
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.events = 0
+
+    def pause(self, hundredths):
+        time.sleep(hundredths / 100.0)
+
+    def key(self, count=1):
+        self.events += count
+        time.sleep(self.latency * count)
+
+    def text(self, text):
+        for character in text:
+            self.key()
+            time.sleep(self.text_pause)
+
+
+#---------------------------------------------------------------------------
+# The compared paths.
+
+def new_mail_by_keystrokes(application, keyboard, addresses):
+    item = application.CreateItem(0)
+    item.Display()
+    keyboard.pause(100)
+    keyboard.text("; ".join(addresses) + ";")
+    keyboard.key(2)
+
+def new_mail_by_object_model(application, keyboard, addresses):
+    item = application.CreateItem(0)
+    recipients = item.Recipients
+    for address in addresses:
+        recipients.Add(address)
+    recipients.ResolveAll()
+    item.Display()
+
+def meeting_response_by_keystrokes(application, keyboard, addresses):
+    # Key("a-a/10, c/20, s/10, enter")
+    keyboard.key(); keyboard.pause(10)
+    keyboard.key(); keyboard.pause(20)
+    keyboard.key(); keyboard.pause(10)
+    keyboard.key()
+
+def meeting_response_by_object_model(application, keyboard, addresses):
+    item = FakeMeetingItem(application)
+    appointment = item.GetAssociatedAppointment(True)
+    response_item = appointment.Respond(3, True)
+    response_item.Send()
+
+
+#---------------------------------------------------------------------------
+# Main benchmark code.
+
+def measure(path, latency, addresses, repeat):
+    application = FakeOutlook(latency)
+    keyboard = FakeKeyboard(latency)
+    start = time.time()
+    for index in xrange(repeat):
+        path(application, keyboard, addresses)
+    duration = (time.time() - start) / repeat
+    return (duration, application.round_trips / repeat,
+            keyboard.events / repeat)
+
+
+def main():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("--latency", type="float", default=0.5,
+                      help="milliseconds per COM round-trip or key event")
+    parser.add_option("--recipients", type="int", default=3,
+                      help="number of recipients of new mail")
+    parser.add_option("--repeat", type="int", default=5,
+                      help="number of times each path is run")
+    options, arguments = parser.parse_args()
+
+    latency = options.latency / 1000.0
+    addresses = ["person%d@example.com" % index
+                 for index in xrange(options.recipients)]
+    paths = [
+             ("new mail, keystrokes", new_mail_by_keystrokes),
+             ("new mail, object model", new_mail_by_object_model),
+             ("meeting response, keystrokes", meeting_response_by_keystrokes),
+             ("meeting response, object model",
+              meeting_response_by_object_model),
+            ]
+
+    print "%-32s %10s %12s %11s" % ("Path", "Time (ms)",
+                                     "Round-trips", "Key events")
+    for name, path in paths:
+        duration, round_trips, events = measure(path, latency, addresses,
+                                                options.repeat)
+        print "%-32s %10.1f %12d %11d" % (name, duration * 1000,
+                                          round_trips, events)
+
+
+if __name__ == "__main__":
+    main()
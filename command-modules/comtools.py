@@ -0,0 +1,351 @@
+#
+# This file is a utility module for Dragonfly command-modules.
+# (c) Copyright 2008 by Christo Butcher
+# Licensed under the LGPL, see <http://www.gnu.org/licenses/>
+#
+
+"""
+Utilities for command-modules which use **COM** automation
+============================================================================
+
+This module is not a command-module itself; it offers functionality
+shared by command-modules which control applications through COM,
+such as ``_outlook.py``, ``_word_styles.py``, ``_explorer_tools.py``
+and ``_tortoisesvn.py``.
+
+Iterating over COM collections
+----------------------------------------------------------------------------
+
+``collection_iter(collection, base)`` yields the items of a COM
+collection.  Some collections are indexed from 0 (for example those of
+``Shell.Application``), others from 1 (for example those of Outlook),
+so the index base must be given.
+
+``collection_values(collection, properties, base)`` yields a tuple of
+the requested property values of each item, fetched in chunks.  With
+``threaded=True`` the values are fetched by a worker thread, which
+reads the next chunk while the caller processes the previous one.
+
+COM profiling
+----------------------------------------------------------------------------
+
+Every COM property access and method call is a round-trip to the
+controlled application.  When profiling is enabled in this module's
+configuration file, the application object of each participating
+grammar is wrapped in a proxy which counts and times these
+round-trips.  They are attributed to the rule being processed, and
+after each recognition the most expensive COM members are printed.
+
+Grammars participate by calling ``profile_rules(grammar)`` after
+adding their rules, and ``profile_application(grammar)`` from their
+``connection_up()`` method.  Both do nothing if profiling is
+disabled.
+
+"""
+
+import time
+import types
+import threading
+import Queue
+
+from dragonfly import Config, Section, Item
+
+
+#---------------------------------------------------------------------------
+# Set up this module's configuration.
+
+config                      = Config("COM profiling")
+config.profile              = Section("Profiling section")
+config.profile.enabled      = Item(False, doc="Whether to count and time COM round-trips of participating grammars.")
+config.profile.report_count = Item(5, doc="Number of most expensive COM members to report after each recognition.")
+#config.generate_config_file()
+config.load()
+
+
+#---------------------------------------------------------------------------
+# Utility functions for iterating over COM collections.
+
+def collection_iter(collection, base):
+    for index in xrange(base, collection.Count + base):
+        yield collection.Item(index)
+
+
+def get_values(item, properties):
+    values = []
+    for name in properties:
+        try:
+            values.append(getattr(item, name))
+        except Exception:
+            values.append(None)
+    return tuple(values)
+
+
+def iter_chunks(collection, properties, base, chunk_size, with_item):
+    # Yield lists of value tuples; items which are None are skipped.
+    count = collection.Count
+    for chunk_start in xrange(base, count + base, chunk_size):
+        chunk_end = min(chunk_start + chunk_size, count + base)
+        chunk = []
+        for index in xrange(chunk_start, chunk_end):
+            item = collection.Item(index)
+            if item is None:
+                continue
+            values = get_values(item, properties)
+            if with_item:
+                values = (item,) + values
+            chunk.append(values)
+        yield chunk
+
+
+def collection_values(collection, properties, base, chunk_size=50,
+                      threaded=False, with_item=False):
+    if not threaded:
+        for chunk in iter_chunks(collection, properties, base,
+                                 chunk_size, with_item):
+            for values in chunk:
+                yield values
+        return
+
+    # COM objects cannot be handed to other threads, so the worker
+    #  receives the collection through a marshalling stream and hands
+    #  back plain values only.
+    if with_item:
+        raise ValueError("Items cannot be returned from a worker thread.")
+    import pythoncom
+    from win32com.client import Dispatch
+    stream = pythoncom.CoMarshalInterThreadInterfaceInStream(
+                pythoncom.IID_IDispatch, unwrap(collection)._oleobj_)
+    chunks = Queue.Queue(maxsize=2)
+    stopped = threading.Event()
+
+    def put(chunk):
+        # Give up if the caller stopped iterating.
+        while not stopped.isSet():
+            try:
+                chunks.put(chunk, True, 0.5)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def worker():
+        pythoncom.CoInitialize()
+        try:
+            try:
+                dispatch = pythoncom.CoGetInterfaceAndReleaseStream(
+                                stream, pythoncom.IID_IDispatch)
+                worker_collection = Dispatch(dispatch)
+                for chunk in iter_chunks(worker_collection, properties,
+                                         base, chunk_size, False):
+                    if not put(chunk):
+                        return
+            except Exception, e:
+                put(e)
+        finally:
+            put(None)
+            pythoncom.CoUninitialize()
+
+    thread = threading.Thread(target=worker)
+    thread.setDaemon(True)
+    thread.start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                break
+            if isinstance(chunk, Exception):
+                raise chunk
+            for values in chunk:
+                yield values
+    finally:
+        stopped.set()
+
+
+#---------------------------------------------------------------------------
+# Profiler which accumulates COM round-trip statistics per rule.
+
+class ComProfiler(object):
+
+    def __init__(self, report_count):
+        self.report_count = report_count
+        self.totals = {}            # (rule, member) -> [calls, seconds].
+        self._current = None
+        self._rule = None
+        self._lock = threading.Lock()
+
+    def wrap(self, target):
+        if isinstance(target, ComProxy):
+            return target
+        return ComProxy(target, self)
+
+    def record(self, member, seconds):
+        self._lock.acquire()
+        try:
+            for stats in (self._current, self.totals):
+                if stats is None:
+                    continue
+                key = (self._rule, member)
+                entry = stats.get(key)
+                if entry is None:
+                    entry = stats[key] = [0, 0.0]
+                entry[0] += 1
+                entry[1] += seconds
+        finally:
+            self._lock.release()
+
+    def begin(self, rule_name):
+        self._rule = rule_name
+        self._current = {}
+
+    def end(self):
+        current, self._current = self._current, None
+        rule_name, self._rule = self._rule, None
+        if current:
+            print self.format_report(current, "COM profile of %r" % rule_name)
+
+    def format_report(self, stats, title):
+        calls = sum([c for c, s in stats.values()])
+        seconds = sum([s for c, s in stats.values()])
+        entries = [(s, c, key) for key, (c, s) in stats.items()]
+        entries.sort(reverse=True)
+        lines = ["%s: %d round-trips in %.1f ms" % (title, calls,
+                                                    seconds * 1000)]
+        for s, c, (rule_name, member) in entries[:self.report_count]:
+            lines.append("    %-30s %5d calls %8.1f ms" % (member, c,
+                                                            s * 1000))
+        return "\n".join(lines)
+
+    def report(self):
+        # Print accumulated statistics, grouped by rule.
+        rule_names = set([rule_name for rule_name, m in self.totals])
+        for rule_name in sorted(rule_names):
+            stats = dict([(key, value)
+                          for key, value in self.totals.items()
+                          if key[0] == rule_name])
+            print self.format_report(stats, "COM totals of %r" % rule_name)
+
+
+#---------------------------------------------------------------------------
+# Proxy which forwards attribute access and calls to a COM object.
+
+plain_types = (basestring, int, long, float, bool, tuple, type(None))
+method_types = (types.MethodType, types.BuiltinMethodType)
+
+
+def unwrap(value):
+    if isinstance(value, ComProxy):
+        return object.__getattribute__(value, "_target")
+    return value
+
+
+class ComProxy(object):
+
+    def __init__(self, target, profiler):
+        object.__setattr__(self, "_target", target)
+        object.__setattr__(self, "_profiler", profiler)
+
+    def _wrap_result(self, value):
+        if isinstance(value, plain_types):
+            return value
+        return self._profiler.wrap(value)
+
+    def __getattr__(self, name):
+        start = time.time()
+        value = getattr(self._target, name)
+        if isinstance(value, method_types):
+            # Only calling a method is a round-trip.
+            return ComMethodProxy(self, name, value)
+        self._profiler.record("get " + name, time.time() - start)
+        return self._wrap_result(value)
+
+    def __setattr__(self, name, value):
+        start = time.time()
+        setattr(self._target, name, unwrap(value))
+        self._profiler.record("set " + name, time.time() - start)
+
+    def __call__(self, *args):
+        start = time.time()
+        value = self._target(*[unwrap(a) for a in args])
+        self._profiler.record("call ()", time.time() - start)
+        return self._wrap_result(value)
+
+    def __iter__(self):
+        iterator = iter(self._target)
+        while True:
+            start = time.time()
+            try:
+                value = iterator.next()
+            except StopIteration:
+                return
+            self._profiler.record("iterate", time.time() - start)
+            yield self._wrap_result(value)
+
+    def __nonzero__(self):
+        return bool(self._target)
+
+    def __eq__(self, other):
+        return self._target == unwrap(other)
+
+    def __ne__(self, other):
+        return self._target != unwrap(other)
+
+    def __hash__(self):
+        return hash(self._target)
+
+    def __str__(self):
+        return str(self._target)
+
+    def __unicode__(self):
+        return unicode(self._target)
+
+    def __repr__(self):
+        return "ComProxy(%r)" % (self._target,)
+
+
+class ComMethodProxy(object):
+
+    def __init__(self, parent, name, method):
+        self._parent = parent
+        self._name = name
+        self._method = method
+
+    def __call__(self, *args, **kwargs):
+        args = [unwrap(a) for a in args]
+        kwargs = dict([(k, unwrap(v)) for k, v in kwargs.items()])
+        start = time.time()
+        value = self._method(*args, **kwargs)
+        self._parent._profiler.record("call %s()" % self._name,
+                                      time.time() - start)
+        return self._parent._wrap_result(value)
+
+
+#---------------------------------------------------------------------------
+# Functions through which grammars participate in profiling.
+
+profiler = ComProfiler(config.profile.report_count)
+
+
+def profile_rules(grammar):
+    if not config.profile.enabled:
+        return
+    for rule in grammar.rules:
+        wrap_rule(rule)
+
+
+def wrap_rule(rule):
+    process_recognition = rule.process_recognition
+    def profiled_process_recognition(node):
+        profiler.begin(rule.name)
+        try:
+            return process_recognition(node)
+        finally:
+            profiler.end()
+    rule.process_recognition = profiled_process_recognition
+
+
+def profile_application(grammar):
+    # ConnectionGrammar exposes its COM handle through a read-only
+    #  property, so the underlying attribute is replaced instead.
+    if not config.profile.enabled or grammar.application is None:
+        return
+    grammar._application = profiler.wrap(grammar.application)
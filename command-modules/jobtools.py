@@ -0,0 +1,370 @@
+#
+# This file is a utility module for Dragonfly command-modules.
+# (c) Copyright 2008 by Christo Butcher
+# Licensed under the LGPL, see <http://www.gnu.org/licenses/>
+#
+
+"""
+Utilities for running **external programs** in the background
+============================================================================
+
+This module is not a command-module itself; it offers a job runner
+shared by command-modules which start external programs, such as
+``_explorer_tools.py`` and ``_tortoisesvn.py``.
+
+A job is a series of command lines which are run one after another by
+a bounded pool of worker threads, so that the recognition thread never
+waits for them.  The output of each job is written to its own log
+file.  Every job has a number by which it can be cancelled; numbers
+are reused once a job is no longer listed, so that they stay small
+enough to be spoken.  A step of a job may also be a Python callable,
+such as the archivers of the ``archivetools`` module, which is called
+with the job and its log.
+Interactive programs, such as editors and dialogs, are started with
+``launch()`` instead, so that they don't occupy a worker.
+
+Commands
+----------------------------------------------------------------------------
+
+The rules below are added to a grammar by the command-modules which
+use this module.
+
+Command: **"list jobs"**
+    Lists the current and recently finished jobs, with their
+    progress and elapsed time.
+
+Command: **"cancel job <n>"**
+    Cancels job number *<n>*, terminating its running program.
+
+Command: **"show job log <n>"**
+    Opens the log file of job number *<n>*.
+
+"""
+
+import os
+import os.path
+import sys
+import subprocess
+import tempfile
+import threading
+import time
+import Queue
+
+from dragonfly import (CompoundRule, IntegerRef, Config, Section, Item)
+
+
+#---------------------------------------------------------------------------
+# Set up this module's configuration.
+
+config                    = Config("job runner")
+config.jobs               = Section("Job runner section")
+config.jobs.log_directory = Item(os.path.join(tempfile.gettempdir(), "dragonfly-jobs"), doc="Directory in which the output of jobs is logged.")
+config.jobs.history       = Item(20, doc="Number of finished jobs which are remembered.")
+config.jobs.command_line_limit = Item(32000, doc="Maximum length of a command line; longer argument lists are split over several command lines.")
+config.jobs.response_file_size = Item(1000, doc="Maximum number of arguments written to one response file.")
+config.lang               = Section("Language section")
+config.lang.list_jobs     = Item("list jobs")
+config.lang.cancel_job    = Item("cancel job <n>")
+config.lang.show_job_log  = Item("show job log <n>")
+#config.generate_config_file()
+config.load()
+
+
+#---------------------------------------------------------------------------
+# Utility function for terminating a process.
+
+def terminate(process):
+    try:
+        process.terminate()
+    except AttributeError:
+        # Python versions before 2.6 lack Popen.terminate().
+        import win32api
+        win32api.TerminateProcess(int(process._handle), 1)
+
+
+#---------------------------------------------------------------------------
+# Utility function for starting interactive programs, such as editors
+#  and dialogs.  These are not run as jobs, because a job's worker
+#  would be held until the program is closed.
+
+def launch(arguments):
+    if not isinstance(arguments, basestring):
+        command_line = subprocess.list2cmdline(arguments)
+    else:
+        command_line = arguments
+    try:
+        process = subprocess.Popen(arguments)
+    except OSError, e:
+        print "Failed to start %s: %s" % (command_line, e)
+        return None
+    print "Launched %s." % command_line
+    return process
+
+
+#---------------------------------------------------------------------------
+# Utility functions for splitting long argument lists.  Windows limits
+#  command lines to 32767 characters, so long lists of paths are split
+#  into several command lines which each fit within the limit.
+
+def split_arguments(prefix, arguments, suffix, limit):
+    base_length = len(subprocess.list2cmdline(prefix + suffix))
+    chunks = []
+    chunk = []
+    length = base_length
+    for argument in arguments:
+        argument_length = len(subprocess.list2cmdline([argument])) + 1
+        if chunk and length + argument_length > limit:
+            chunks.append(chunk)
+            chunk = []
+            length = base_length
+        chunk.append(argument)
+        length += argument_length
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def write_response_file(arguments):
+    # Write one argument per line to a new file; return its path.  The
+    #  file should be passed to JobRunner.submit() as a temporary file,
+    #  so that it is removed when the job finishes.
+    directory = config.jobs.log_directory
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    handle, path = tempfile.mkstemp(suffix=".lst", dir=directory)
+    encoding = sys.getfilesystemencoding() or "utf-8"
+    f = os.fdopen(handle, "w")
+    try:
+        for argument in arguments:
+            if isinstance(argument, unicode):
+                argument = argument.encode(encoding)
+            f.write(argument + "\n")
+    finally:
+        f.close()
+    return path
+
+
+#---------------------------------------------------------------------------
+# Job class which tracks the progress of a series of command lines.
+
+class Job(object):
+
+    def __init__(self, number, name, commands, log_path, temp_files=()):
+        self.number = number
+        self.name = name
+        self.commands = commands
+        self.log_path = log_path
+        self.temp_files = list(temp_files)
+        self.state = "queued"
+        self.completed = 0
+        self.failed = 0
+        self.start_time = None
+        self.end_time = None
+        self.cancelled = False
+        self._process = None
+
+    def __str__(self):
+        return "job %d [%s] %s: %d/%d done, %d failed, %.1fs" \
+               % (self.number, self.state, self.name, self.completed,
+                  len(self.commands), self.failed, self.elapsed)
+
+    @property
+    def elapsed(self):
+        if self.start_time is None:
+            return 0.0
+        return (self.end_time or time.time()) - self.start_time
+
+    @property
+    def finished(self):
+        return self.state in ("done", "cancelled")
+
+    def cancel(self):
+        self.cancelled = True
+        process = self._process
+        if process is not None and process.poll() is None:
+            terminate(process)
+
+    def run(self):
+        self.state = "running"
+        self.start_time = time.time()
+        log = open(self.log_path, "w")
+        try:
+            for command in self.commands:
+                if self.cancelled:
+                    break
+                if callable(command):
+                    self._call(command, log)
+                    continue
+                if not isinstance(command, basestring):
+                    command_line = subprocess.list2cmdline(command)
+                else:
+                    command_line = command
+                log.write("> %s\n" % command_line)
+                log.flush()
+                try:
+                    self._process = subprocess.Popen(command, stdout=log,
+                                                     stderr=subprocess.STDOUT)
+                    returncode = self._process.wait()
+                except OSError, e:
+                    log.write("Failed to start: %s\n" % (e,))
+                    returncode = None
+                log.write("Exit code: %s\n" % (returncode,))
+                log.flush()
+                self.completed += 1
+                if returncode != 0:
+                    self.failed += 1
+        finally:
+            log.close()
+            self._process = None
+            self.end_time = time.time()
+            self.remove_temp_files()
+            if self.cancelled: self.state = "cancelled"
+            else:              self.state = "done"
+
+    def remove_temp_files(self):
+        # Remove files which were only needed while the job ran, such
+        #  as response files.
+        for path in self.temp_files:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self.temp_files = []
+
+    def _call(self, command, log):
+        # Steps which are Python callables run within this job's worker
+        #  thread; they receive the job, so that they can check whether
+        #  it was cancelled, and its log.
+        log.write("> %s\n" % (command,))
+        log.flush()
+        try:
+            command(self, log)
+            succeeded = True
+        except Exception, e:
+            log.write("Failed: %s\n" % (e,))
+            succeeded = False
+        log.flush()
+        self.completed += 1
+        if not succeeded:
+            self.failed += 1
+
+
+#---------------------------------------------------------------------------
+# Job runner with a bounded pool of worker threads.
+
+class JobRunner(object):
+
+    _number_lock = threading.Lock()
+
+    def __init__(self, name, workers):
+        self.name = name
+        self.workers = workers
+        self.jobs = []
+        self._queue = Queue.Queue()
+        self._threads = []
+        runners.append(self)
+
+    def submit(self, name, commands, temp_files=()):
+        directory = config.jobs.log_directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        # Each job gets the lowest number not held by a listed job of
+        #  any runner, so that numbers stay within the spoken range.
+        self._number_lock.acquire()
+        try:
+            self._forget_finished()
+            used = set([j.number for j in all_jobs()])
+            number = 1
+            while number in used:
+                number += 1
+            log_path = os.path.join(directory, "job-%d.log" % number)
+            job = Job(number, name, commands, log_path, temp_files)
+            self.jobs.append(job)
+        finally:
+            self._number_lock.release()
+
+        self._start_workers()
+        self._queue.put(job)
+        print "Started %s." % job
+        return job
+
+    def _start_workers(self):
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._worker)
+            thread.setDaemon(True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _forget_finished(self):
+        finished = [j for j in self.jobs if j.finished]
+        for job in finished[:-config.jobs.history]:
+            self.jobs.remove(job)
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            if job.cancelled:
+                job.state = "cancelled"
+                job.remove_temp_files()
+                continue
+            try:
+                job.run()
+            except Exception, e:
+                print "Job %d failed: %s" % (job.number, e)
+            print "Finished %s." % job
+
+
+runners = []
+
+def all_jobs():
+    jobs = []
+    for runner in runners:
+        jobs.extend(runner.jobs)
+    jobs.sort(key=lambda j: j.number)
+    return jobs
+
+def find_job(number):
+    for job in all_jobs():
+        if job.number == number:
+            return job
+    print "No job number %d." % number
+    return None
+
+
+#---------------------------------------------------------------------------
+# Rules for controlling jobs by voice.
+
+class ListJobsRule(CompoundRule):
+
+    spec = config.lang.list_jobs
+
+    def _process_recognition(self, node, extras):
+        jobs = all_jobs()
+        if not jobs:
+            print "No jobs."
+        for job in jobs:
+            print "  - %s" % job
+
+
+class CancelJobRule(CompoundRule):
+
+    spec = config.lang.cancel_job
+    extras = [IntegerRef("n", 1, 1000)]
+
+    def _process_recognition(self, node, extras):
+        job = find_job(extras["n"])
+        if job:
+            job.cancel()
+            print "Cancelled %s." % job
+
+
+class ShowJobLogRule(CompoundRule):
+
+    spec = config.lang.show_job_log
+    extras = [IntegerRef("n", 1, 1000)]
+
+    def _process_recognition(self, node, extras):
+        job = find_job(extras["n"])
+        if job and os.path.isfile(job.log_path):
+            os.startfile(job.log_path)
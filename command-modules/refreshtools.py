@@ -0,0 +1,103 @@
+#
+# This file is a utility module for Dragonfly command-modules.
+# (c) Copyright 2008 by Christo Butcher
+# Licensed under the LGPL, see <http://www.gnu.org/licenses/>
+#
+
+"""
+Utilities for **refreshing indexes** in the background
+============================================================================
+
+This module is not a command-module itself; it offers the machinery
+shared by the indexes of command-modules such as ``_outlook.py`` and
+``_tortoisesvn.py``, which are refreshed by a worker thread and saved
+to disk.
+
+``BackgroundRefresher`` runs a subclass's ``refresh()`` method in a
+daemon thread, at most one at a time.  Results which must be applied
+on the recognition thread, such as new contents of a ``DictList``,
+are handed over with ``set_pending()`` and picked up there by
+``pop_pending()``.  Refreshers which use COM set ``uses_com``, so
+that COM is initialized for the worker thread.
+
+``replace_file()`` moves a newly written file over an existing one.
+
+"""
+
+import os
+import os.path
+import threading
+
+
+#---------------------------------------------------------------------------
+# Utility function for replacing a file by a newly written one.
+
+def replace_file(temp_path, path):
+    # Windows cannot rename over an existing file, so the old file is
+    #  removed first.
+    if os.path.exists(path):
+        os.remove(path)
+    os.rename(temp_path, path)
+
+
+#---------------------------------------------------------------------------
+# Base class of indexes which are refreshed by a worker thread.
+
+class BackgroundRefresher(object):
+
+    uses_com = False
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = None
+        self._thread = None
+
+    @property
+    def refreshing(self):
+        return self._thread is not None and self._thread.isAlive()
+
+    def start_refresh(self, *args):
+        if self.refreshing:
+            return False
+        self._thread = threading.Thread(target=self._run, args=args)
+        self._thread.setDaemon(True)
+        self._thread.start()
+        return True
+
+    def set_pending(self, pending):
+        # Called from the worker thread.
+        self._lock.acquire()
+        try:
+            self._pending = pending
+        finally:
+            self._lock.release()
+
+    def pop_pending(self):
+        # Called from the main thread; applies and returns new results
+        #  if available.
+        self._lock.acquire()
+        try:
+            pending, self._pending = self._pending, None
+        finally:
+            self._lock.release()
+        if pending is not None:
+            self.apply_pending(pending)
+        return pending
+
+    def apply_pending(self, pending):
+        pass
+
+    def refresh(self, *args):
+        raise NotImplementedError("Call to virtual method refresh()"
+                                  " in base class BackgroundRefresher")
+
+    def _run(self, *args):
+        if not self.uses_com:
+            self.refresh(*args)
+            return
+        import pythoncom
+        pythoncom.CoInitialize()
+        try:
+            self.refresh(*args)
+        finally:
+            pythoncom.CoUninitialize()
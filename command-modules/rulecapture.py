@@ -0,0 +1,71 @@
+#
+# This file is a utility module for Dragonfly command-modules.
+# (c) Copyright 2008 by Christo Butcher
+# Licensed under the LGPL, see <http://www.gnu.org/licenses/>
+#
+
+"""
+Utilities for capturing the **actions of mapping rules**
+============================================================================
+
+This module is not a command-module itself; it lets command-modules
+such as ``_cmdmemory.py`` learn which action a mapping rule produced
+for a recognition, so that the action can be executed again later
+without mimicking the recognition's words.
+
+Grammars take part by calling ``capture_rules()`` after their rules
+have been added, in the same way as ``comtools.profile_rules()``.
+Only the mapping rules of those grammars are wrapped; other grammars
+are not affected.  Listeners added with ``add_listener()`` are called
+with the rule, the recognized words, the action and the extras of
+each recognition of a wrapped rule.  Extras whose names start with an
+underscore, such as the parse tree, are not passed on.
+
+"""
+
+from dragonfly import MappingRule, ActionBase
+
+
+#---------------------------------------------------------------------------
+# Listeners which are notified of captured actions.
+
+listeners = []
+
+def add_listener(listener):
+    if listener not in listeners:
+        listeners.append(listener)
+
+def remove_listener(listener):
+    if listener in listeners:
+        listeners.remove(listener)
+
+
+#---------------------------------------------------------------------------
+# Functions through which grammars participate in capturing.
+
+def capture_rules(grammar):
+    for rule in grammar.rules:
+        if isinstance(rule, MappingRule):
+            wrap_rule(rule)
+
+
+def wrap_rule(rule):
+    process_recognition = rule._process_recognition
+    def captured_process_recognition(value, extras):
+        notify(rule, value, extras)
+        return process_recognition(value, extras)
+    rule._process_recognition = captured_process_recognition
+
+
+def notify(rule, value, extras):
+    node = extras.get("_node")
+    if not listeners or node is None or not isinstance(value, ActionBase):
+        return
+    words = tuple(node.words())
+    public_extras = dict([(name, extra) for name, extra in extras.iteritems()
+                          if not name.startswith("_")])
+    for listener in listeners:
+        try:
+            listener(rule, words, value, public_extras)
+        except Exception, e:
+            print "Rule capture listener %r failed: %s" % (listener, e)
@@ -45,6 +45,7 @@ from dragonfly.all import (Grammar, AppContext, Rule, MappingRule,
                            Key, Text,
                            Config, Section, Item)
 from dragonfly.grammar.integer_en  import Integer, Digits
+from textemit import FastText
 
 
 #---------------------------------------------------------------------------
@@ -65,7 +66,7 @@ class CommandRule(MappingRule):
                 "mark all [as] read":                  Key("cs-r"),
                 "mark all [as] unread":                Key("cs-u"),
                 "search [bar]":                        Key("a-s"),
-                "search [for] <text>":                 Key("a-s") + Text("%(text)s\n"),
+                "search [for] <text>":                 Key("a-s") + FastText("%(text)s\n"),
                }
     extras   = [
                 Integer("n", 1, 20),
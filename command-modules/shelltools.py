@@ -0,0 +1,169 @@
+#
+# This file is a utility module for Dragonfly command-modules.
+# (c) Copyright 2008 by Christo Butcher
+# Licensed under the LGPL, see <http://www.gnu.org/licenses/>
+#
+
+"""
+Utilities for command-modules which control **Windows Explorer**
+============================================================================
+
+This module is not a command-module itself; it offers functionality
+shared by command-modules which control Windows Explorer windows
+through ``Shell.Application``, such as ``_explorer_tools.py`` and
+``_tortoisesvn.py``.
+
+Shell window cache
+----------------------------------------------------------------------------
+
+Finding the Explorer window which is in the foreground means
+enumerating all Shell windows over COM.  The ``shell_windows`` cache
+maps window handles to Shell window objects.  It is refreshed when
+Windows reports that a Shell window was opened or closed, or, if those
+events are not available, at most once per recognition.
+
+Grammars which use the cache call ``shell_windows.begin()`` from their
+``_process_begin()`` method; the window found during a recognition is
+remembered until the next recognition begins.
+
+Selection snapshots
+----------------------------------------------------------------------------
+
+``shell_windows.get_selection(application, handle)`` returns a
+``Selection`` of the given Explorer window: the paths of its selected
+items and its current directory, read in a single pass.  The snapshot
+is shared by all grammars during a recognition, so that commands which
+need both the selection and the directory read them only once.
+
+"""
+
+import os
+from urllib import unquote
+
+from comtools import collection_values, unwrap
+
+
+#---------------------------------------------------------------------------
+# Utility function for converting Explorer location URLs to paths.
+
+def url_to_path(url):
+    # "file:///C:/My%20Files" -> "C:\My Files", and
+    #  "file://server/share" -> "\\server\share".
+    if url.startswith("file:///"):
+        path = url[8:]
+    elif url.startswith("file://"):
+        path = "//" + url[7:]
+    else:
+        return url
+    return unquote(path).replace("/", os.sep)
+
+
+#---------------------------------------------------------------------------
+# Immutable snapshot of an Explorer window's selection.
+
+class Selection(object):
+
+    def __init__(self, handle, paths, directory):
+        self._handle = handle
+        self._paths = tuple(paths)
+        self._directory = directory
+
+    handle    = property(lambda self: self._handle)
+    paths     = property(lambda self: self._paths)
+    directory = property(lambda self: self._directory)
+
+    @property
+    def filenames(self):
+        return [os.path.basename(p) for p in self._paths]
+
+    def __repr__(self):
+        return "Selection(%r, %r)" % (self._directory, self._paths)
+
+
+#---------------------------------------------------------------------------
+# Event handler which invalidates the cache when windows come and go.
+
+class ShellWindowsEvents(object):
+
+    cache = None
+
+    def OnWindowRegistered(self, cookie):
+        if self.cache: self.cache.invalidate()
+
+    def OnWindowRevoked(self, cookie):
+        if self.cache: self.cache.invalidate()
+
+
+#---------------------------------------------------------------------------
+# Cache of Shell windows, indexed by window handle.
+
+class ShellWindowCache(object):
+
+    def __init__(self):
+        self._windows = None        # Window handle -> Shell window.
+        self._events = None         # None: not yet connected,
+                                    #  False: events unavailable.
+        self._memo = {}             # Lookups of the current recognition.
+        self._selections = {}       # Snapshots of the current recognition.
+
+    def begin(self):
+        self._memo = {}
+        self._selections = {}
+        if not self._events:
+            self.invalidate()
+
+    def invalidate(self):
+        self._windows = None
+
+    def reset(self):
+        self._windows = None
+        self._events = None
+        self._memo = {}
+        self._selections = {}
+
+    def get_window(self, application, handle):
+        if handle in self._memo:
+            return self._memo[handle]
+        window = None
+        if self._windows is not None:
+            window = self._windows.get(handle)
+        if window is None:
+            self._refresh(application)
+            window = self._windows.get(handle)
+        self._memo[handle] = window
+        return window
+
+    def get_selection(self, application, handle):
+        if handle in self._selections:
+            return self._selections[handle]
+        window = self.get_window(application, handle)
+        selection = None
+        if window is not None:
+            items = window.Document.SelectedItems()
+            paths = [p for (p,) in collection_values(items, ("Path",), 0)]
+            directory = url_to_path(window.LocationURL)
+            selection = Selection(handle, paths, directory)
+        self._selections[handle] = selection
+        return selection
+
+    def _refresh(self, application):
+        windows = application.Windows()
+        self._connect_events(windows)
+        values = collection_values(windows, ("HWND",), 0, with_item=True)
+        self._windows = dict([(hwnd, window) for window, hwnd in values])
+
+    def _connect_events(self, windows):
+        if self._events is not None:
+            return
+        try:
+            from win32com.client import WithEvents
+            events = WithEvents(unwrap(windows), ShellWindowsEvents)
+            events.cache = self
+            self._events = events
+        except Exception, e:
+            print "Shell window events unavailable, refreshing per" \
+                  " recognition instead: %s" % (e,)
+            self._events = False
+
+
+shell_windows = ShellWindowCache()
@@ -0,0 +1,154 @@
+#
+# This file is a utility module for Dragonfly command-modules.
+# (c) Copyright 2008 by Christo Butcher
+# Licensed under the LGPL, see <http://www.gnu.org/licenses/>
+#
+
+"""
+Utilities for quickly emitting **dictated text**
+============================================================================
+
+This module is not a command-module itself; it offers the
+``FastText`` action to command-modules such as ``_firefox.py`` and
+``_multiedit.py``.
+
+``FastText`` is used in the same way as ``Text``.  Short text is
+typed character by character, as ``Text`` does.  Long text, and text
+with characters which cannot be typed reliably, is pasted through the
+clipboard instead; the clipboard's previous contents are restored
+afterwards.  Only text can be restored, so text is always typed while
+the clipboard holds anything else, such as an image or copied files.
+
+The length above which text is pasted is learned per application:
+the time taken to type each character and the time taken to paste
+are measured, and text is pasted when typing it would take longer.
+Tabs and newlines are always typed, so that they still move between
+fields and submit forms.
+
+"""
+
+import re
+import time
+import win32clipboard
+import win32con
+import pywintypes
+
+from dragonfly import (Text, Paste, Clipboard, Window,
+                       Config, Section, Item)
+
+
+#---------------------------------------------------------------------------
+# Set up this module's configuration.
+
+config                    = Config("text emitter")
+config.text               = Section("Text emitter section")
+config.text.enabled       = Item(True, doc="Whether long text is pasted instead of typed.")
+config.text.threshold     = Item(40, doc="Length above which text is pasted, until costs have been measured.")
+config.text.min_threshold = Item(8, doc="Length below which text is never pasted.")
+config.text.restore_delay = Item(0.2, doc="Seconds to wait before restoring the clipboard after pasting.")
+#config.generate_config_file()
+config.load()
+
+
+#---------------------------------------------------------------------------
+# Utility function for checking whether the clipboard can be restored.
+
+text_formats = (win32con.CF_TEXT, win32con.CF_OEMTEXT,
+                win32con.CF_UNICODETEXT, win32con.CF_LOCALE)
+
+def clipboard_holds_only_text():
+    try:
+        win32clipboard.OpenClipboard()
+    except pywintypes.error:
+        return False
+    try:
+        format_id = win32clipboard.EnumClipboardFormats(0)
+        while format_id:
+            if format_id not in text_formats:
+                return False
+            format_id = win32clipboard.EnumClipboardFormats(format_id)
+    finally:
+        win32clipboard.CloseClipboard()
+    return True
+
+
+#---------------------------------------------------------------------------
+# Emitter which learns per application whether typing or pasting is
+#  quicker.  Costs are kept as moving averages, so that they follow
+#  changes in the application's responsiveness.
+
+class TextEmitter(object):
+
+    smoothing = 0.2
+
+    def __init__(self):
+        self.char_costs = {}        # Executable -> seconds per character.
+        self.paste_costs = {}       # Executable -> seconds per paste.
+
+    def get_threshold(self, executable):
+        char_cost = self.char_costs.get(executable)
+        paste_cost = self.paste_costs.get(executable)
+        if not char_cost or paste_cost is None:
+            return config.text.threshold
+        return max(int(paste_cost / char_cost), config.text.min_threshold)
+
+    def should_paste(self, executable, text):
+        if not config.text.enabled or len(text) < config.text.min_threshold:
+            return False
+        try:
+            text.encode("ascii")
+        except UnicodeError:
+            pass
+        else:
+            if len(text) <= self.get_threshold(executable):
+                return False
+        return clipboard_holds_only_text()
+
+    def emit(self, text):
+        executable = Window.get_foreground().executable.lower()
+        for part in control_pattern.split(text):
+            if not part:
+                continue
+            start = time.clock()
+            is_control = part in ("\t", "\n")
+            if not is_control and self.should_paste(executable, part):
+                self.paste(part)
+                self._update(self.paste_costs, executable,
+                             time.clock() - start)
+            else:
+                Text(part, static=True).execute()
+                if not is_control:
+                    self._update(self.char_costs, executable,
+                                 (time.clock() - start) / len(part))
+
+    def paste(self, text):
+        saved = Clipboard(from_system=True)
+        Paste(text, static=True).execute()
+        # The application reads the clipboard while processing the
+        #  keystroke, so it is only restored after a short delay.
+        time.sleep(config.text.restore_delay)
+        saved.copy_to_system()
+
+    def _update(self, costs, executable, value):
+        previous = costs.get(executable)
+        if previous is None:
+            costs[executable] = value
+        else:
+            costs[executable] = previous + self.smoothing * (value - previous)
+
+
+control_pattern = re.compile(r"([\t\n])")
+emitter = TextEmitter()
+
+
+#---------------------------------------------------------------------------
+# Action which emits text through the shared emitter.
+
+class FastText(Text):
+
+    def _parse_spec(self, spec):
+        return spec
+
+    def _execute_events(self, text):
+        emitter.emit(text)
+        return True
@@ -20,6 +20,7 @@ a powerful text and source code editor.
 from dragonfly import (Grammar, AppContext, MappingRule,
                        Dictation, Choice, IntegerRef, NumberRef,
                        Key, Text, Repeat)
+from textemit import FastText
 
 
 #---------------------------------------------------------------------------
@@ -44,7 +45,7 @@ class CommandRule(MappingRule):
         # File menu.
         "new file":                     Key("c-n"),
         "open file":                    Key("c-o, s-tab"),
-        "open filename <dict>":         Key("c-o") + Text("%(dict)s\n"),
+        "open filename <dict>":         Key("c-o") + FastText("%(dict)s\n"),
         "close file":                   Key("a-f, c"),
         "close <1to9> files":           Key("a-f, c") * Repeat(extra="1to9"),
         "close window <1to9>":          Key("a-w, %(1to9)d/20, a-f, c"),
@@ -66,11 +67,11 @@ class CommandRule(MappingRule):
 
         # Search menu.
         "search find":                  Key("c-f"),
-        "search find <dict>":           Key("c-f") + Text("%(dict)s\n"),
+        "search find <dict>":           Key("c-f") + FastText("%(dict)s\n"),
         "search next":                  Key("f3"),
         "search replace":               Key("c-r"),
         "search replace <dict> with <dict2>": Key("c-r") \
-                                        + Text("%(dict)s\t%(dict2)s"),
+                                        + FastText("%(dict)s\t%(dict2)s"),
         "find in files":                Key("a-s, i"),
         "find this word in files":      Key("c-j, a-s, i"),
         "phi phi this word":            Key("c-j, a-s, i/20, enter"),